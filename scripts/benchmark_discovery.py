@@ -0,0 +1,129 @@
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import check_mongo_config
+import check_mongo_indexes
+import get_mongo_collection_indexes
+from fake_cluster import (
+    DEFAULT_WIRE_VERSION, FakeTopology, MONITORING_HOST)
+from mongo_connections import registry
+
+DEFAULT_NODES = (10, 100, 1000)
+
+log = logging.getLogger('benchmark_discovery')
+
+
+def run_config(topology, output_dir):
+    check_mongo_config.main(
+        MONITORING_HOST,
+        '3.0.0',
+        os.path.join(output_dir, 'config'),
+        topology_ttl=0)
+
+
+def run_indexes(topology, output_dir):
+    check_mongo_indexes.main(
+        ','.join(topology.mongos),
+        os.path.join(output_dir, 'indexes'),
+        False,
+        True)
+
+
+def run_collection_indexes(topology, output_dir):
+    get_mongo_collection_indexes.main(
+        MONITORING_HOST, os.path.join(output_dir, 'collection_indexes'))
+
+
+SCRIPTS = (
+    ('check_mongo_config', run_config),
+    ('check_mongo_indexes', run_indexes),
+    ('get_mongo_collection_indexes', run_collection_indexes),
+)
+
+
+def benchmark(
+    nodes, latency, dead, hanging, timeout,
+    wire_version=DEFAULT_WIRE_VERSION):
+    # Every script runs against a fresh topology and an empty registry, so
+    # connections and round trips are its own.
+    rows = []
+    for name, run in SCRIPTS:
+        topology = FakeTopology.with_nodes(
+            nodes,
+            latency=latency,
+            timeout=timeout,
+            wire_version=wire_version)
+        shard_members = [
+            host for _, hosts in topology.shards for host in hosts[1:]]
+        for host in shard_members[:dead]:
+            topology.kill(host)
+        for host in shard_members[dead:dead + hanging]:
+            topology.hang(host)
+        registry.close_all()
+        registry.factory = topology.client
+        output_dir = tempfile.mkdtemp(prefix='benchmark_discovery')
+        start = time.time()
+        try:
+            run(topology, output_dir)
+        finally:
+            shutil.rmtree(output_dir)
+        stats = topology.stats()
+        stats['seconds'] = round(time.time() - start, 3)
+        stats['script'] = name
+        rows.append(stats)
+        log.warning(
+            '{script} {nodes} nodes: {seconds}s, {clients} clients, '
+            '{connections} connections, {round_trips} round trips'.format(
+                **stats))
+    registry.close_all()
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'nodes',
+        help='Cluster sizes to run',
+        nargs='*',
+        type=int,
+        default=list(DEFAULT_NODES))
+    parser.add_argument(
+        '--latency',
+        help='Seconds every round trip takes',
+        type=float,
+        default=0.001)
+    parser.add_argument(
+        '--dead',
+        help='Number of dead secondaries',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--hanging',
+        help='Number of secondaries that time out',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--timeout',
+        help='Seconds before a dead or hanging node fails',
+        type=float,
+        default=0.5)
+    parser.add_argument(
+        '--wire_version',
+        help='maxWireVersion the fake servers report',
+        type=int,
+        default=DEFAULT_WIRE_VERSION)
+    args = parser.parse_args()
+    # the scripts log every host at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    for nodes in args.nodes:
+        benchmark(
+            nodes,
+            args.latency,
+            args.dead,
+            args.hanging,
+            args.timeout,
+            args.wire_version)
@@ -0,0 +1,197 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+from check_mongo_indexes import html_output_writer, raw_output_writer
+from index_diff import IndexDiffer
+from index_reference import ReferenceBuilder
+from index_store import IndexStore
+from result_stream import broadcast
+from sample_dataset import generate
+
+SIZES = {
+    'small': {'servers': 6, 'namespaces': 100, 'indexes_per_namespace': 5},
+    'medium': {
+        'servers': 60, 'namespaces': 2000, 'indexes_per_namespace': 6},
+    'large': {
+        'servers': 300, 'namespaces': 10000, 'indexes_per_namespace': 8},
+}
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+DEFAULT_TOLERANCE = 0.25
+# Measurements up to these never count as regressions, RSS moves in pages
+# and allocator arenas whatever the stage does
+NOISE_FLOORS = {'seconds': 0.05, 'peak_rss_growth_mb': 1.0}
+
+log = logging.getLogger('benchmark_indexes')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def peak_rss_growth_mb(func):
+    # ru_maxrss only ever holds the peak of the whole process, so func runs
+    # in a forked child. On Linux the child's peak starts out at its current
+    # RSS, whatever the earlier stages left behind.
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            rss = peak_rss_mb()
+            func()
+            os.write(write_fd, repr(peak_rss_mb() - rss))
+            status = 0
+        except Exception:
+            log.exception('Stage failed while measuring its memory')
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        growth = fp.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('Memory measurement exited with {0}'.format(status))
+    return float(growth)
+
+
+def timed(stats, name, func):
+    # The stage runs twice: once in a child for its memory, then here for
+    # its time and its result
+    growth = peak_rss_growth_mb(func)
+    start = time.time()
+    result = func()
+    stats[name] = {
+        'seconds': round(time.time() - start, 4),
+        'peak_rss_growth_mb': round(growth, 1)
+    }
+    log.info('{0}: {1}'.format(name, stats[name]))
+    return result
+
+
+def run_benchmark(size, drift):
+    _, results = generate(drift=drift, **SIZES[size])
+    stats = {}
+    store = IndexStore()
+    builder = ReferenceBuilder(store)
+
+    def build_reference():
+        for server, namespaces in results['servers'].iteritems():
+            member = store.fingerprint_member(namespaces)
+            store.add_member(server, member)
+            builder.add(member['namespaces'])
+        return builder.reference()
+
+    def rebuild():
+        return sum(
+            len(member['namespaces']) for _, member in store.members())
+
+    def diff():
+        differ = IndexDiffer(reference, store)
+        return sum(
+            len(differ.diff_member(member))
+            for _, member in store.members())
+
+    def write(writer):
+        output = {'errors': {}, 'timings': {}, 'changes': None}
+        with open(os.devnull, 'w') as out_file:
+            if writer is html_output_writer:
+                consumer = writer(out_file, size, output, reference, store)
+            else:
+                consumer = writer(out_file, output, reference, store)
+            broadcast(store.members(), [consumer])
+
+    reference = timed(stats, 'reference', build_reference)
+    pairs = timed(stats, 'members', rebuild)
+    mismatches = timed(stats, 'diff', diff)
+    timed(stats, 'html', lambda: write(html_output_writer))
+    timed(stats, 'raw', lambda: write(raw_output_writer))
+    log.info('{0}: {1} mismatched namespaces, {2} distinct specs'.format(
+        size, mismatches, len(store)))
+    # the diff stage rebuilds every member too
+    rebuild_seconds = stats['members']['seconds']
+    log.info(
+        '{0}: {1} member-namespace pairs, {2:.2f}us per pair to rebuild the '
+        'members, {3:.2f}us per pair to diff them'.format(
+            size,
+            pairs,
+            rebuild_seconds * 1e6 / max(pairs, 1),
+            (stats['diff']['seconds'] - rebuild_seconds) * 1e6 /
+            max(pairs, 1)))
+    return stats
+
+
+def regressions(stats, baseline, tolerance):
+    for stage, measured in sorted(stats.items()):
+        expected = baseline.get(stage)
+        if not expected:
+            continue
+        for metric, floor in sorted(NOISE_FLOORS.items()):
+            # ignore noise on stages that barely register
+            limit = max(expected[metric] * (1 + tolerance), floor)
+            if measured[metric] > limit:
+                yield stage, metric, measured[metric], expected[metric]
+
+
+def main(sizes, drift, save_baseline, tolerance):
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as fp:
+            baselines = json.load(fp)
+    failed = False
+    for size in sizes:
+        log.info('Benchmarking {0} dataset {1}'.format(size, SIZES[size]))
+        stats = run_benchmark(size, drift)
+        if save_baseline:
+            baselines[size] = stats
+            continue
+        for stage, metric, measured, expected in regressions(
+                stats, baselines.get(size, {}), tolerance):
+            failed = True
+            log.warning(
+                'Regression in {0} {1} {2}: {3} against baseline {4}'.format(
+                    size, stage, metric, measured, expected))
+    if save_baseline:
+        with open(BASELINE_FILE, 'w') as out_file:
+            json.dump(
+                baselines,
+                out_file,
+                indent=4,
+                separators=(',', ': '),
+                sort_keys=True)
+        log.info('Saved baselines to {0}'.format(BASELINE_FILE))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'sizes',
+        help='Datasets to run',
+        nargs='*',
+        choices=sorted(SIZES),
+        default=['small', 'medium'])
+    parser.add_argument(
+        '--drift',
+        help='Share of (server, namespace) pairs differing from the reference',
+        type=float,
+        default=0.01)
+    parser.add_argument(
+        '--save_baseline',
+        help='Store the measurements as the new baselines',
+        action='store_true')
+    parser.add_argument(
+        '--tolerance',
+        help='Allowed slowdown or memory growth over the baseline',
+        type=float,
+        default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+    sys.exit(1 if main(
+        args.sizes, args.drift, args.save_baseline, args.tolerance) else 0)
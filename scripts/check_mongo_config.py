@@ -1,56 +1,335 @@
 #!/usr/bin/python
 
 import argparse
+import copy
 from distutils.version import StrictVersion
 import json
 import logging
-from pymongo import MongoClient
+import threading
 
-from mongo_setup import MONITORING_DB, MONITORING_HOSTS, CONNECTION_TIMEOUT_MS
+from cluster_scheduler import ClusterScheduler
+from host_identity import VisitedSet, canonical_host
+from html_report import PagedReport, open_buffered
+from mongo_connections import DEFAULT_MAX_CLIENTS, lease_client, registry
+from mongo_setup import (
+    MONITORING_DB,
+    CONNECTION_TIMEOUT_MS,
+    TOPOLOGY_CACHE_MAX_TTL_SECONDS,
+    TOPOLOGY_CACHE_TTL_SECONDS,
+    live_hosts)
+from probe_pool import (
+    ProbePool, DEFAULT_CONCURRENCY, DEFAULT_CLUSTER_CONCURRENCY)
+from probe_timing import PhaseTimer, TimedProbeError, TimingCollector
+from result_stream import NDJSONSink, coroutine, read_records
+from topology_cache import (
+    get_sharded_topology, open_topology_cache, sharded_fingerprint)
+from version_probe import get_prober, DEFAULT_PROBE, PROBES
 
 
 logging.basicConfig(
     level='INFO',
     format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
 log = logging.getLogger('check_mongo_config')
+results_lock = threading.Lock()
 
 
-def main(mongo_uri, minimum_version, output_file):
-    conn = MongoClient(mongo_uri, connectTimeoutMS=CONNECTION_TIMEOUT_MS)
-    final_results = {
-        'minimum_version': minimum_version,
-        'results': {}
-    }
-    for seed_host in conn[MONITORING_DB][MONITORING_HOSTS].find().sort(
-        [('live', 1), ('_id', 1)]):
-        results = {
-            'mongod': [],
-            'mongos': [],
-            'config': [],
-            'errors': []
-        }
+class ProbeRun(object):
+    # Collaborators shared by every probe of one run.
+
+    def __init__(
+        self, pool=None, prober=None, topology_cache=None, sink=None):
+        self.pool = pool or ProbePool(1)
+        self.prober = prober or get_prober()
+        self.topology_cache = topology_cache
+        self.sink = sink
+        self.cluster = None
+        self.visited = VisitedSet()
+        self.reported = VisitedSet()
+        self.timings = TimingCollector()
+
+    def for_cluster(self, label):
+        run = copy.copy(self)
+        run.pool = self.pool.for_cluster()
+        run.cluster = label
+        return run
+
+    def report(self, identity):
+        # True the first time identity is reported for this cluster. A node
+        # several monitored clusters share is probed once but listed under
+        # each of them.
+        return self.reported.add((self.cluster, identity))
+
+    def emit(self, identity, kind, entry):
+        if self.sink:
+            self.sink.write({
+                'cluster': self.cluster,
+                'host': identity,
+                'kind': kind,
+                'entry': entry
+            })
+
+    def restore(self, records):
+        # Marks every host of an earlier, interrupted run as visited and
+        # reported, returns the clusters that run completed.
+        done = set()
+        for record in records:
+            if record.get('done'):
+                done.add(record['cluster'])
+                continue
+            identity = tuple(record['host'])
+            kind = record['kind']
+            entry = record['entry']
+            if kind == 'discovery':
+                continue
+            if kind == 'errors':
+                self.visited.record(identity, error=TimedProbeError(
+                    entry.get('error', 'Failed in an earlier run'),
+                    entry.get('timings', {})))
+            else:
+                process = 'mongos' if kind == 'mongos' else 'mongod'
+                self.visited.record(identity, result=(
+                    process, entry['version'], entry.get('timings', {})))
+            self.reported.add((record['cluster'], identity))
+        return done
+
+
+def main(
+    mongo_uri,
+    minimum_version,
+    output_file,
+    concurrency=DEFAULT_CONCURRENCY,
+    cluster_concurrency=DEFAULT_CLUSTER_CONCURRENCY,
+    probe=DEFAULT_PROBE,
+    topology_ttl=TOPOLOGY_CACHE_TTL_SECONDS,
+    stream_file=None,
+    resume=False,
+    prometheus_file=None,
+    html_pages=False,
+    replay=None):
+    if replay:
+        log.info('Replaying {0}'.format(replay))
+        write_reports(
+            revalidated(read_records(replay), minimum_version),
+            output_file,
+            minimum_version,
+            {},
+            html_pages)
+        return
+    with lease_client(
+            mongo_uri, connectTimeoutMS=CONNECTION_TIMEOUT_MS) as conn:
+        run = ProbeRun(
+            ProbePool(concurrency, cluster_concurrency),
+            get_prober(probe),
+            open_topology_cache(conn, topology_ttl))
+        stream_file = stream_file or output_file + '.ndjson'
+        done = set()
+        if resume:
+            done = run.restore(read_records(stream_file))
+            log.info('Resuming {0}, {1} clusters already done'.format(
+                stream_file, len(done)))
+        run.sink = NDJSONSink(stream_file, resume)
+        clusters = []
+        for cluster in get_clusters(live_hosts(conn[MONITORING_DB])):
+            if cluster[0] in done:
+                log.info('Skipping {0} since it is already done'.format(
+                    cluster[0]))
+                continue
+            clusters.append(cluster)
+
+        def run_cluster(cluster):
+            label, hosts, skip_mongos = cluster
+            process_cluster(
+                label,
+                hosts,
+                minimum_version,
+                skip_mongos,
+                run.for_cluster(label))
+            run.sink.write({'cluster': label, 'done': True})
+
+        with run.sink:
+            run.pool.map(run_cluster, clusters)
+        probe_stats = run.prober.stats.summary()
+        log.info('Probe stats {0}'.format(probe_stats))
+        write_reports(
+            read_records(stream_file),
+            output_file,
+            minimum_version,
+            probe_stats,
+            html_pages)
+        if prometheus_file:
+            run.timings.write_textfile(prometheus_file)
+        log.info('Connection registry stats {0}'.format(registry.stats()))
+
+
+def run_daemon(
+    mongo_uri,
+    minimum_version,
+    output_file,
+    concurrency=DEFAULT_CONCURRENCY,
+    cluster_concurrency=DEFAULT_CLUSTER_CONCURRENCY,
+    probe=DEFAULT_PROBE,
+    topology_ttl=TOPOLOGY_CACHE_TTL_SECONDS,
+    prometheus_file=None):
+    # Clients stay open in the registry between cycles, only the visited
+    # set is reset for every batch of due clusters. The textfile keeps the
+    # timings of every cluster, a batch only replaces its own.
+    with lease_client(
+            mongo_uri, connectTimeoutMS=CONNECTION_TIMEOUT_MS) as conn:
+        topology_cache = open_topology_cache(conn, topology_ttl)
+        pool = ProbePool(concurrency, cluster_concurrency)
+        prober = get_prober(probe)
+        scheduler = ClusterScheduler('config_interval_seconds')
+        latest = {}
+        timings = TimingCollector()
+
+        def check(seed_hosts):
+            run = ProbeRun(pool, prober, topology_cache)
+
+            def run_cluster(cluster):
+                label, hosts, skip_mongos = cluster
+                return label, process_cluster(
+                    label,
+                    hosts,
+                    minimum_version,
+                    skip_mongos,
+                    run.for_cluster(label))
+
+            checked = []
+            for label, results in pool.map(
+                    run_cluster, get_clusters(seed_hosts)):
+                latest[label] = results
+                checked.append(label)
+            for label in set(latest) - scheduler.labels():
+                del latest[label]
+            timings.replace_clusters(run.timings, checked)
+            timings.retain_clusters(latest)
+            final_results = {
+                'minimum_version': minimum_version,
+                'probe_stats': prober.stats.summary(),
+                'results': latest
+            }
+            with open(output_file+'.json', 'w') as fp:
+                json.dump(final_results, fp)
+            write_html(output_file+'.html', final_results)
+            if prometheus_file:
+                timings.write_textfile(prometheus_file)
+            log.info('Connection registry stats {0}'.format(registry.stats()))
+
+        scheduler.run(lambda: live_hosts(conn[MONITORING_DB]), check)
+
+
+def get_clusters(seed_hosts):
+    clusters = []
+    for seed_host in seed_hosts:
         label = seed_host['_id']
-        live = seed_host.get('live', False)
         log.info('Processing {0}'.format(label))
-        if not live:
-            log.warning('Skipping {0} since it is not live'.format(label))
-            continue
         hosts = seed_host.get('hosts')
         skip_mongos = not seed_host.get('process_mongos', True)
         if not hosts:
             log.warning('Skipping {0} since no hosts specified'.format(label))
             continue
-        if isinstance(hosts, basestring):
-            process(hosts, minimum_version, results, skip_mongos)
-        elif isinstance(hosts, list):
-            for host in hosts:
-                process(host, minimum_version, results, skip_mongos)
+        clusters.append((label, hosts, skip_mongos))
+    return clusters
+
+
+def write_reports(
+    records, output_file, minimum_version, probe_stats, html_pages=False):
+    # Single pass over the stream records, a cluster is only held in memory
+    # until its done marker is read.
+    with open_buffered(output_file+'.json') as json_file:
+        json_file.write(
+            '{"minimum_version": %s, "probe_stats": %s, "results": {' %
+            (json.dumps(minimum_version), json.dumps(probe_stats)))
+        clusters = iter_cluster_results(records)
+        if html_pages:
+            html_writer = paged_cluster_writer(output_file, minimum_version)
+        else:
+            html_writer = cluster_writer(output_file, minimum_version)
+        for index, (label, results) in enumerate(clusters):
+            if index:
+                json_file.write(', ')
+            json_file.write(
+                '%s: %s' % (json.dumps(label), json.dumps(results)))
+            html_writer.send((label, results))
+        json_file.write('}}')
+        html_writer.close()
+
+
+@coroutine
+def cluster_writer(output_file, minimum_version):
+    with open_buffered(output_file+'.html') as html_file:
+        write_html_header(html_file, minimum_version)
+        try:
+            while True:
+                label, results = yield
+                write_cluster(html_file, label, results)
+        except GeneratorExit:
+            write_html_footer(html_file)
+
+
+@coroutine
+def paged_cluster_writer(output_file, minimum_version):
+    # <output_file>.html links to one page per cluster
+    with PagedReport(
+            output_file,
+            'Check Mongo Clusters - base version %s' % minimum_version
+            ) as report:
+        report.index.write('\t\t<ul>\n')
+        try:
+            while True:
+                label, results = yield
+                with report.page(label, cluster_summary(results)) as page:
+                    write_cluster(page, label, results)
+        except GeneratorExit:
+            report.index.write('\t\t</ul>\n')
+
+
+def iter_cluster_results(records):
+    pending = {}
+    for record in records:
+        label = record['cluster']
+        results = pending.setdefault(label, new_results())
+        if record.get('done'):
+            yield label, pending.pop(label)
         else:
-            log.warning('Skipping %s as hosts incorrectly specified' % label)
-        final_results['results'][label] = results
-    with open(output_file+'.json', 'w') as fp:
-        json.dump(final_results, fp)
-    write_html(output_file+'.html', final_results)
+            results[record['kind']].append(record['entry'])
+    for label in sorted(pending):
+        log.warning('Cluster {0} did not complete'.format(label))
+        yield label, pending[label]
+
+
+def revalidated(records, minimum_version):
+    # Checks the versions of a recorded run against minimum_version
+    for record in records:
+        entry = record.get('entry')
+        if entry and 'version' in entry:
+            entry['valid'] = get_valid_version(
+                entry['version'], minimum_version)
+        yield record
+
+
+def new_results():
+    return {
+        'mongod': [],
+        'mongos': [],
+        'config': [],
+        'errors': [],
+        'discovery': []
+    }
+
+
+def process_cluster(label, hosts, minimum_version, skip_mongos, run):
+    results = new_results()
+    if isinstance(hosts, basestring):
+        hosts = [hosts]
+    elif not isinstance(hosts, list):
+        log.warning('Skipping %s as hosts incorrectly specified' % label)
+        return results
+    run.pool.map(
+        lambda host: process(
+            host, minimum_version, results, skip_mongos, run=run),
+        hosts)
+    return results
 
 
 def process(
@@ -59,126 +338,213 @@ def process(
     results,
     skip_mongos=False,
     process_subs=True,
-    process_override=None):
+    process_override=None,
+    run=None,
+    set_name=None):
     log.debug('Processing {0} with subs {1}'.format(server_uri, process_subs))
+    run = run or ProbeRun()
+
+    def probe():
+        timer = PhaseTimer()
+        try:
+            with run.pool.slot(), lease_client(
+                    server_uri,
+                    connectTimeoutMS=CONNECTION_TIMEOUT_MS,
+                    slaveOk=True) as conn:
+                # the client connects in the background, the first round
+                # trip waits for it
+                with timer.phase('connect'):
+                    conn['admin'].command('ping')
+                log.debug('Obtained connection to {0}'.format(server_uri))
+                with timer.phase('command'):
+                    process, version = run.prober.probe(conn)
+        except Exception as e:
+            raise TimedProbeError(e, timer.timings)
+        return process, version, timer.timings
+
+    timer = PhaseTimer()
+    identity = (server_uri, set_name or '')
     try:
-        conn = MongoClient(
-            server_uri,
-            connectTimeoutMS=CONNECTION_TIMEOUT_MS,
-            slaveOk=True)
-        log.debug('Obtained connection to {0}'.format(server_uri))
-        server_status = conn['admin'].command(
-            {'serverStatus': 1, 'recordStats': 0})
-        process = server_status['process']
-        version = server_status['version']
+        with timer.phase('dns'):
+            identity = canonical_host(server_uri, set_name)
+        (process, version, timings), _ = run.visited.visit(identity, probe)
+        timer.timings.update(timings)
         if not process_subs or process == 'mongod':
-            if process_override:
-                add_server_info(
-                    results,
-                    server_uri,
-                    process_override,
-                    version,
-                    minimum_version)
-            else:
-                add_server_info(
-                    results,
-                    server_uri,
-                    process,
-                    version,
-                    minimum_version)
+            if not run.report(identity):
+                log.debug('Already reported {0}'.format(server_uri))
+                return
+            run.timings.observe(run.cluster, server_uri, timer.timings)
+            run.emit(identity, *add_server_info(
+                results,
+                server_uri,
+                process_override or process,
+                version,
+                minimum_version,
+                timer.timings))
         else:
-            process_sharded_cluster(results, conn, minimum_version, skip_mongos)
-    except:
-        results['errors'].append({'server': server_uri})
+            with lease_client(
+                    server_uri,
+                    connectTimeoutMS=CONNECTION_TIMEOUT_MS,
+                    slaveOk=True) as conn:
+                process_sharded_cluster(
+                    results, conn, minimum_version, skip_mongos, run,
+                    server_uri)
+    except Exception as e:
+        log.warning('Error processing {0}: {1}'.format(server_uri, e))
+        timer.timings.update(getattr(e, 'timings', {}))
+        if run.report(identity):
+            run.timings.observe(run.cluster, server_uri, timer.timings)
+            run.emit(identity, *add_error(
+                results, server_uri, str(e), timer.timings))
 
 
 def get_valid_version(version, minimum_version):
     return StrictVersion(version) >= StrictVersion(minimum_version)
 
 
-def process_sharded_cluster(results, conn, minimum_version, skip_mongos):
+def process_sharded_cluster(
+    results, conn, minimum_version, skip_mongos, run=None, seed=None):
     log.info('In processing sharded cluster for {0}'.format(conn))
-    process_configs(results, conn, minimum_version)
+    run = run or ProbeRun()
+    timer = PhaseTimer()
+    with timer.phase('discovery'):
+        with run.pool.slot():
+            fingerprinted = sharded_fingerprint(conn)
+        # a client of several mongoses has no single address
+        seed = seed or ','.join(
+            '{0}:{1}'.format(*node) for node in sorted(conn.nodes))
+        identity = ('cluster', fingerprinted[0])
+        if not run.report(identity):
+            log.info('Cluster of {0} already processed'.format(seed))
+            return
+        # discovered once per run, every label naming the cluster lists it
+        topology, _ = run.visited.visit(
+            identity,
+            lambda: get_sharded_topology(
+                conn,
+                seed,
+                get_replica_set_members,
+                run.topology_cache,
+                run.pool,
+                fingerprinted=fingerprinted))
+    run.timings.observe(run.cluster, seed, timer.timings)
+    entry = {'server': seed, 'timings': timer.timings}
+    with results_lock:
+        results['discovery'].append(entry)
+    run.emit(identity, 'discovery', entry)
+    process_configs(results, topology['configs'], minimum_version, run)
     if not skip_mongos:
-        process_mongos(results, conn, minimum_version)
+        process_mongos(results, topology['mongos'], minimum_version, run)
     else:
         log.info('Skipping processing mongos')
-    process_mongods(results, conn, minimum_version)
+    process_mongods(results, topology['shards'], minimum_version, run)
     log.info('Done processing sharded cluster')
 
 
-def process_mongos(results, conn, minimum_version):
-    log.info('In processing mongos for {0}'.format(conn))
-    mongos_list = conn['config']['mongos'].find()
-    for mongos in mongos_list:
-        process(mongos['_id'], minimum_version, results, process_subs=False)
+def process_mongos(results, mongos_list, minimum_version, run):
+    log.info('In processing mongos')
+    run.pool.map(
+        lambda mongos: process(
+            mongos,
+            minimum_version,
+            results,
+            process_subs=False,
+            run=run),
+        mongos_list)
     log.info('Done processing mongos')
 
 
-def process_mongods(results, conn, minimum_version):
-    log.info('In processing mongods for {0}'.format(conn))
-    shards = conn['config']['shards'].find({}, {'_id': 0, 'host': 1})
-    for replica_set in shards:
-        candidates = replica_set['host'].split('/')[-1]
-        success = False
-        replica_set_members = None
-        for mongod in candidates.split(','):
-            try:
-                replica_set_members = get_replica_set_members(mongod)
-                success = True
-                break
-            except:
-                log.exception('Error getting replica set info for {0}'.format(
-                    mongod))
-        if success:
-            for member in replica_set_members:
-                process(member, minimum_version, results)
-        else:
-            results['errors'].append({'server': mongod})
+def process_mongods(results, shards, minimum_version, run):
+    log.info('In processing mongods')
+    run.pool.map(
+        lambda shard: process_shard(results, shard, minimum_version, run),
+        shards)
     log.info('Done processing mongods')
 
 
-def process_configs(results, conn, minimum_version):
-    log.info('In processing config for {0}'.format(conn))
-    cmd_line_opts = conn['admin'].command('getCmdLineOpts')
-    config_servers = cmd_line_opts['parsed']['configdb']
-    for config_server in config_servers.split(','):
-        if ":" not in config_server:
-            config_server = config_server + ':27019'
-        process(
+def process_shard(results, shard, minimum_version, run):
+    if shard['members'] is None:
+        # shard['error'] is the last member tried, none of them answered
+        server = shard['error']
+        identity = (server, shard.get('set_name') or '')
+        if run.report(identity):
+            run.emit(identity, *add_error(
+                results,
+                server,
+                'No member of shard {0} answered'.format(shard['_id'])))
+        return
+    run.pool.map(
+        lambda member: process(
+            member,
+            minimum_version,
+            results,
+            run=run,
+            set_name=shard.get('set_name')),
+        shard['members'])
+
+
+def process_configs(results, config_servers, minimum_version, run):
+    log.info('In processing config')
+    run.pool.map(
+        lambda config_server: process(
             config_server,
             minimum_version,
             results,
-            process_override='config')
+            process_override='config',
+            run=run),
+        config_servers)
     log.info('Done processing configs')
 
 
-def add_server_info(results, server, process, version, minimum_version):
+def add_server_info(
+    results, server, process, version, minimum_version, timings=None):
     if 'mongos' in process:
         process = 'mongos'
-    results[process].append({
+    entry = {
         'server': server,
         'version': version,
         'valid': get_valid_version(version, minimum_version)
-    })
+    }
+    if timings is not None:
+        entry['timings'] = timings
+    with results_lock:
+        results[process].append(entry)
+    return process, entry
+
+
+def add_error(results, server, error=None, timings=None):
+    entry = {'server': server}
+    if error is not None:
+        entry['error'] = error
+    if timings is not None:
+        entry['timings'] = timings
+    with results_lock:
+        results['errors'].append(entry)
+    return 'errors', entry
 
 
 def get_replica_set_members(node):
     log.info('Get replica set info for {0}'.format(node))
-    conn = MongoClient(node)
-    rsconfig = conn['local']['system.replset'].find_one()
+    with lease_client(node) as conn:
+        rsconfig = conn['local']['system.replset'].find_one()
     if rsconfig:
         return [member['host'] for member in rsconfig['members']]
     else:
-        return [member]
+        return [node]
 
 
 def write_html(file_name, results):
-    with open(file_name, 'w') as out_file:
-        out_file.write('<html>\n')
-        out_file.write('\t<head>\n')
-        out_file.write('\t\t<title>Check Mongo Clusters</title>')
-        out_file.write("""
+    with open_buffered(file_name) as out_file:
+        write_html_header(out_file, results['minimum_version'])
+        write_output_body(out_file, results['results'])
+        write_html_footer(out_file)
+
+
+def write_html_header(out_file, minimum_version):
+    out_file.write('<html>\n')
+    out_file.write('\t<head>\n')
+    out_file.write('\t\t<title>Check Mongo Clusters</title>')
+    out_file.write("""
         <style type="text/css">
             .error {
                 background-color: white;
@@ -189,52 +555,75 @@ def write_html(file_name, results):
                 color: orange;
             }
         </style>\n""")
-        out_file.write('\t</head>\n')
-        out_file.write('\t<body>\n')
-        out_file.write(
-            '\t\t<h1>Base version - %s</h1>\n' %
-            results['minimum_version'])
-        write_output_body(out_file, results['results'])
-        out_file.write('\t</body>\n')
-        out_file.write('</html>\n')
-        out_file.flush()
+    out_file.write('\t</head>\n')
+    out_file.write('\t<body>\n')
+    out_file.write(
+        '\t\t<h1>Base version - %s</h1>\n' % minimum_version)
+
+
+def write_html_footer(out_file):
+    out_file.write('\t</body>\n')
+    out_file.write('</html>\n')
+    out_file.flush()
 
 
 def write_output_body(out_file, results):
     for cluster_name, cluster_result in results.iteritems():
-        out_file.write('\n\t\t<h2>%s</h2>\n' % cluster_name)
-        out_file.write('\t\t<h3>Config servers</h3>\n')
-        write_table(out_file, cluster_result.get('config', []))
-        out_file.write('\t\t<h3>Data nodes</h3>\n')
-        write_table(out_file, cluster_result.get('mongod', []))
-        out_file.write('\t\t<h3>Mongos</h3>\n')
-        write_table(out_file, cluster_result.get('mongos', []))
-        out_file.write('\t\t<h3>Errors / unreachable</h3>\n')
-        out_file.write('\t\t<ul>\n')
-        for server in cluster_result.get('errors', []):
+        write_cluster(out_file, cluster_name, cluster_result)
+
+
+def write_cluster(out_file, cluster_name, cluster_result):
+    out_file.write('\n\t\t<h2>%s</h2>\n' % cluster_name)
+    out_file.write('\t\t<h3>Config servers</h3>\n')
+    write_table(out_file, cluster_result.get('config', []))
+    out_file.write('\t\t<h3>Data nodes</h3>\n')
+    write_table(out_file, cluster_result.get('mongod', []))
+    out_file.write('\t\t<h3>Mongos</h3>\n')
+    write_table(out_file, cluster_result.get('mongos', []))
+    out_file.write('\t\t<h3>Errors / unreachable</h3>\n')
+    out_file.write('\t\t<ul>\n')
+    for server in cluster_result.get('errors', []):
+        if 'error' in server:
+            out_file.write(
+                '\t\t\t<li class="error">%s - %s</li>\n' %
+                (server['server'], server['error']))
+        else:
             out_file.write(
                 '\t\t\t<li class="error">%s</li>\n' %
                 server['server'])
-        out_file.write('\t\t</ul>\n')
+    out_file.write('\t\t</ul>\n')
 
 
 def write_table(out_file, servers):
+    # Servers below the minimum version are listed, the valid ones only
+    # counted per version
     if not servers:
         return
     out_file.write('\t\t<table border="1">\n')
     out_file.write('\t\t\t<tr><th>Server</th><th>Version</th></tr>\n')
+    valid = {}
     for server in servers:
         if server['valid']:
-            out_file.write(
-                '\t\t\t<tr><td>%s</td><td>%s</td></tr>\n' %
-                (server['server'], server['version']))
+            valid[server['version']] = valid.get(server['version'], 0) + 1
         else:
             out_file.write(
                 '\t\t\t<tr><td>%s</td><td class="warning">%s</td></tr>\n' %
                 (server['server'], server['version']))
+    for version in sorted(valid):
+        out_file.write(
+            '\t\t\t<tr><td>%d servers</td><td>%s</td></tr>\n' %
+            (valid[version], version))
     out_file.write('\t\t</table>\n')
 
 
+def cluster_summary(cluster_result):
+    invalid = sum(
+        1 for kind in ('config', 'mongod', 'mongos')
+        for server in cluster_result.get(kind, [])
+        if not server['valid'])
+    return '%d below minimum version, %d errors' % (
+        invalid, len(cluster_result.get('errors', [])))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('mongo_uri', help='Mongo(d/s) URI')
@@ -246,5 +635,80 @@ if __name__ == '__main__':
         '--output_file',
         help='Output file',
         default='mongo_check.json')
+    parser.add_argument(
+        '--concurrency',
+        help='Maximum number of hosts probed at the same time',
+        type=int,
+        default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        '--cluster_concurrency',
+        help='Maximum number of hosts of one cluster probed at the same time',
+        type=int,
+        default=DEFAULT_CLUSTER_CONCURRENCY)
+    parser.add_argument(
+        '--probe',
+        help='Strategy used to read the process type and version',
+        choices=sorted(PROBES.keys()),
+        default=DEFAULT_PROBE)
+    parser.add_argument(
+        '--topology_ttl',
+        help='Seconds a discovered topology is reused, 0 disables the '
+        'cache, at most %d' % TOPOLOGY_CACHE_MAX_TTL_SECONDS,
+        type=int,
+        default=TOPOLOGY_CACHE_TTL_SECONDS)
+    parser.add_argument(
+        '--stream_file',
+        help='NDJSON file results are appended to, defaults to '
+        '<output_file>.ndjson')
+    parser.add_argument(
+        '--resume',
+        help='Skip hosts and clusters already in the stream file',
+        action='store_true')
+    parser.add_argument(
+        '--html_pages',
+        help='Write <output_file>.html as an index with one page per '
+        'cluster under <output_file>_pages',
+        action='store_true')
+    parser.add_argument(
+        '--replay',
+        help='Stream file of an earlier run (<output_file>.ndjson) the '
+        'reports are rebuilt from without probing any server')
+    parser.add_argument(
+        '--daemon',
+        help='Keep running and check each cluster on its own interval',
+        action='store_true')
+    parser.add_argument(
+        '--max_clients',
+        help='Maximum number of open MongoClients',
+        type=int,
+        default=DEFAULT_MAX_CLIENTS)
+    parser.add_argument(
+        '--prometheus_file',
+        help='Prometheus textfile the per phase probe timings are '
+        'written to')
     args = parser.parse_args()
-    main(args.mongo_uri, args.minimum_version, args.output_file)
+    registry.max_clients = args.max_clients
+    if args.daemon:
+        run_daemon(
+            args.mongo_uri,
+            args.minimum_version,
+            args.output_file,
+            args.concurrency,
+            args.cluster_concurrency,
+            args.probe,
+            args.topology_ttl,
+            args.prometheus_file)
+    else:
+        main(
+            args.mongo_uri,
+            args.minimum_version,
+            args.output_file,
+            args.concurrency,
+            args.cluster_concurrency,
+            args.probe,
+            args.topology_ttl,
+            args.stream_file,
+            args.resume,
+            args.prometheus_file,
+            args.html_pages,
+            args.replay)
@@ -1,151 +1,497 @@
 #!/usr/bin/python
 
 import argparse
+import contextlib
 import logging
 import simplejson as json
+import threading
 # import sys
 
-from pymongo import MongoClient, ReadPreference
+from bson.son import SON
+from pymongo import ReadPreference
 
+from cluster_scheduler import ClusterScheduler
+from html_report import PagedReport, open_buffered
+from index_collectors import as_namespace_list, get_collector
+from index_diff import IndexDiffer
+from index_fingerprint import database_name
+from index_redundancy import analyze
+from index_reference import (
+    DEFAULT_REFERENCE_MODE, REFERENCE_MODES, ReferenceBuilder)
+from index_snapshot import (
+    changes_collector, load_snapshot, new_changes, snapshot_writer)
+from index_store import IndexStore
+from mongo_connections import DEFAULT_MAX_CLIENTS, lease_client, registry
+from mongo_setup import (
+    MONITORING_DB,
+    CONNECTION_TIMEOUT_MS,
+    TOPOLOGY_CACHE_MAX_TTL_SECONDS,
+    TOPOLOGY_CACHE_TTL_SECONDS,
+    live_hosts)
+from probe_pool import ProbePool, DEFAULT_CONCURRENCY
+from probe_timing import PhaseTimer, TimingCollector
+from result_stream import NDJSONSink, broadcast, coroutine, read_records
 from sample_index_results import REFERENCE, RESULTS
+from topology_cache import (
+    get_replica_set_topology, get_sharded_topology, open_topology_cache)
 
 logging.basicConfig(
     level='INFO',
     format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
 log = logging.getLogger('check_mongo')
+results_lock = threading.Lock()
 
+DEFAULT_DATABASE_CONCURRENCY = 4
 
-def main(mongo_uri, output_file, simulate, output_json):
+
+class IndexRun(object):
+    # Collaborators shared by every member of one run. The pool reads members
+    # in parallel and the databases of each member up to its own limit.
+
+    def __init__(self, sink=None, cluster=None, pool=None):
+        self.sink = sink
+        self.cluster = cluster
+        self.pool = pool or ProbePool(1)
+        self.specs = IndexStore()
+        self.done = set()
+        self.timings = TimingCollector()
+
+    def restore(self, records, results, reference_builder):
+        # Rebuilds the reference and errors of an earlier, interrupted run
+        # so its members can be skipped.
+        for record in records:
+            if 'spec' in record:
+                self.specs.put(record['spec'], record['indexes'])
+                continue
+            server = record['server']
+            if 'error' in record:
+                results['errors'][server] = record['error']
+            else:
+                reference_builder.add(
+                    record['namespaces'], record.get('primary', False))
+            if 'timings' in record:
+                results['timings'][server] = record['timings']
+            self.done.add(server)
+
+
+@contextlib.contextmanager
+def monitoring_topology_cache(monitoring_uri, ttl_seconds):
+    # The topology cache of the monitoring database, None without one. Its
+    # client stays leased while the cache is in use.
+    if not monitoring_uri:
+        yield None
+        return
+    with lease_client(
+            monitoring_uri, connectTimeoutMS=CONNECTION_TIMEOUT_MS) as conn:
+        yield open_topology_cache(conn, ttl_seconds)
+
+
+def main(
+    mongo_uri,
+    output_file,
+    simulate,
+    output_json,
+    monitoring_uri=None,
+    topology_ttl=TOPOLOGY_CACHE_TTL_SECONDS,
+    stream_file=None,
+    resume=False,
+    prometheus_file=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    database_concurrency=DEFAULT_DATABASE_CONCURRENCY,
+    reference_mode=DEFAULT_REFERENCE_MODE,
+    snapshot_file=None,
+    since=None,
+    dataset=None,
+    html_pages=False,
+    replay=None,
+    timings=None):
+    # timings is a collector shared by several runs, the textfile then
+    # holds the timings of all of them
     cleaned = mongo_uri.strip()
-    out_html_file_name = output_file+'.html'
-    with open(out_html_file_name, 'w') as out_html_file:
-        if not simulate:
-            results = {
-                'servers': {},
-                'errors': {}
-            }
-            reference = {}
-            log.info('Processing URI {0}'.format(cleaned))
-            conn = MongoClient(
-                cleaned,
-                read_preference=ReadPreference.SECONDARY_PREFERRED)
+    if replay:
+        # Two lazy passes over the recorded stream, the first rebuilds the
+        # specs, errors and reference, the second feeds the members to the
+        # outputs.
+        results = {
+            'servers': {},
+            'errors': {},
+            'timings': {}
+        }
+        run = IndexRun(cluster=cleaned)
+        specs = run.specs
+        reference_builder = ReferenceBuilder(specs, reference_mode)
+        run.restore(read_records(replay), results, reference_builder)
+        log.info('Replaying {0}, {1} members'.format(replay, len(run.done)))
+        reference = reference_builder.reference()
+
+        def servers():
+            return iter_servers(read_records(replay), specs)
+    elif not simulate:
+        results = {
+            'servers': {},
+            'errors': {},
+            'timings': {}
+        }
+        run = IndexRun(
+            cluster=cleaned,
+            pool=ProbePool(concurrency, database_concurrency))
+        specs = run.specs
+        reference_builder = ReferenceBuilder(specs, reference_mode)
+        stream_file = stream_file or output_file + '.ndjson'
+        if resume:
+            run.restore(
+                read_records(stream_file), results, reference_builder)
+            log.info('Resuming {0}, {1} members already done'.format(
+                stream_file, len(run.done)))
+        run.sink = NDJSONSink(stream_file, resume)
+        log.info('Processing URI {0}'.format(cleaned))
+        cache_lease = monitoring_topology_cache(monitoring_uri, topology_ttl)
+        client_lease = lease_client(
+            cleaned,
+            read_preference=ReadPreference.SECONDARY_PREFERRED)
+        with cache_lease as topology_cache, client_lease as conn, run.sink:
             log.debug('Obtained connection to {0}'.format(cleaned))
             if conn.is_mongos:
-                process_mongos(results, conn, cleaned, reference)
+                process_mongos(
+                    results,
+                    conn,
+                    cleaned,
+                    reference_builder,
+                    topology_cache,
+                    run)
             else:
-                replica_set_members = get_replica_set_members(cleaned)
+                replica_set_members = get_replica_set_topology(
+                    conn, cleaned, get_replica_set_members, topology_cache)
                 process_replica_set_members(
                     replica_set_members,
-                    results, reference)
+                    results, reference_builder, run)
+        reference = reference_builder.reference()
+        if timings is None:
+            timings = run.timings
         else:
-            results = RESULTS
-            reference = REFERENCE
-        log.info('Done processing. Creating output.')
-        if output_json:
-            out_raw_file_name = output_file+'.raw'
-            with open(out_raw_file_name, 'w') as out_raw_file:
-                write_raw_output(out_raw_file, results, reference)
-        write_html_output(out_html_file, cleaned, results, reference)
+            timings.replace_clusters(run.timings, [cleaned])
+        if prometheus_file:
+            timings.write_textfile(prometheus_file)
+
+        def servers():
+            return iter_servers(read_records(stream_file), specs)
+    else:
+        results = RESULTS
+        reference = REFERENCE
+        if dataset:
+            with open(dataset) as fp:
+                generated = json.load(fp, object_pairs_hook=SON)
+            results = generated['RESULTS']
+            reference = generated['REFERENCE']
+        specs = IndexStore()
+        for server, namespaces in results['servers'].iteritems():
+            specs.add_member(server, specs.fingerprint_member(namespaces))
+
+        def servers():
+            return specs.members()
+    log.info('Done processing. Creating output.')
+    # A single pass over the members feeds every output, only the
+    # reference and one member at a time are held in memory.
+    consumers = []
+    changes = None
+    if snapshot_file:
+        consumers.append(snapshot_writer(snapshot_file, cleaned, specs))
+    if since:
+        changes = new_changes()
+        consumers.append(
+            changes_collector(load_snapshot(since), specs, changes))
+    output = {
+        'errors': results['errors'],
+        'timings': results.get('timings', {}),
+        'changes': changes
+    }
+    out_files = []
+    if output_json:
+        out_files.append(open_buffered(output_file+'.raw'))
+        consumers.append(
+            raw_output_writer(out_files[-1], output, reference, specs))
+    if html_pages:
+        consumers.append(paged_html_writer(
+            PagedReport(output_file, 'Indexes for %s' % cleaned),
+            output,
+            reference,
+            specs))
+    else:
+        out_files.append(open_buffered(output_file+'.html'))
+        consumers.append(html_output_writer(
+            out_files[-1], cleaned, output, reference, specs))
+    try:
+        broadcast(servers(), consumers)
+    finally:
+        for out_file in out_files:
+            out_file.close()
+    if snapshot_file:
+        log.info('Saved snapshot {0}'.format(snapshot_file))
+    log.info('Connection registry stats {0}'.format(registry.stats()))
+
+
+def run_daemon(
+    monitoring_uri,
+    output_file,
+    output_json,
+    topology_ttl=TOPOLOGY_CACHE_TTL_SECONDS,
+    prometheus_file=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    database_concurrency=DEFAULT_DATABASE_CONCURRENCY,
+    reference_mode=DEFAULT_REFERENCE_MODE):
+    # Each due cluster gets its own <output_file>_<label> reports, the
+    # prometheus textfile keeps the timings of every scheduled cluster.
+    # Clients stay open in the registry between cycles.
+    scheduler = ClusterScheduler('index_interval_seconds')
+    timings = TimingCollector()
+    cluster_hosts = {}
+
+    def check(seed_hosts):
+        for seed_host in seed_hosts:
+            label = seed_host['_id']
+            hosts = seed_host.get('hosts')
+            if not hosts:
+                log.warning(
+                    'Skipping {0} since no hosts specified'.format(label))
+                continue
+            if isinstance(hosts, list):
+                hosts = ','.join(hosts)
+            cluster_hosts[label] = hosts.strip()
+            main(
+                hosts,
+                '{0}_{1}'.format(output_file, label),
+                False,
+                output_json,
+                monitoring_uri,
+                topology_ttl,
+                concurrency=concurrency,
+                database_concurrency=database_concurrency,
+                reference_mode=reference_mode,
+                timings=timings)
+        for label in set(cluster_hosts) - scheduler.labels():
+            del cluster_hosts[label]
+        timings.retain_clusters(cluster_hosts.values())
+        if prometheus_file:
+            timings.write_textfile(prometheus_file)
+
+    with lease_client(
+            monitoring_uri,
+            connectTimeoutMS=CONNECTION_TIMEOUT_MS) as monitoring_conn:
+        scheduler.run(
+            lambda: live_hosts(monitoring_conn[MONITORING_DB]), check)
+
+
+def iter_servers(records, specs):
+    # A spec record always comes before the first member that uses it
+    for record in records:
+        if 'spec' in record:
+            specs.put(record['spec'], record['indexes'])
+        elif 'namespaces' in record:
+            yield record['server'], {
+                'namespaces': record['namespaces'],
+                'databases': record['databases']
+            }
+
 
+def add_error(results, server, error, run=None, timings=None):
+    with results_lock:
+        results['errors'][server] = error
+    record = {'server': server, 'error': error}
+    if timings is not None:
+        add_timings(results, server, timings, run)
+        record['timings'] = timings
+    if run and run.sink:
+        run.sink.write(record)
 
-def process_mongos(results, conn, mongos_uri, reference):
+
+def add_timings(results, server, timings, run=None):
+    with results_lock:
+        results['timings'][server] = timings
+    if run:
+        run.timings.observe(run.cluster, server, timings)
+
+
+def process_mongos(
+    results,
+    conn,
+    mongos_uri,
+    reference_builder,
+    topology_cache=None,
+    run=None):
     log.info('In processing mongods for mongos {0}'.format(mongos_uri))
-    shards = conn['config']['shards'].find({}, {'_id': 0, 'host': 1})
-    for replica_set in shards:
-        candidates = replica_set['host'].split('/')[-1]
-        success = False
-        replica_set_members = None
-        for mongod in candidates.split(','):
-            try:
-                replica_set_members = get_replica_set_members(mongod)
-                success = True
-                break
-            except:
-                log.exception(
-                    'Error getting replica set info for {0}'.format(mongod))
-        if success:
-            process_replica_set_members(replica_set_members, results, reference)
+    timer = PhaseTimer()
+    with timer.phase('discovery'):
+        topology = get_sharded_topology(
+            conn,
+            mongos_uri,
+            get_replica_set_members,
+            topology_cache,
+            include_configs=False)
+    add_timings(results, mongos_uri, timer.timings, run)
+    members = []
+    for shard in topology['shards']:
+        if shard['members'] is not None:
+            members.extend(shard['members'])
         else:
-            results['errors'][mongos_uri] = 'Cannot get replica set info'
+            add_error(results, mongos_uri, 'Cannot get replica set info', run)
+    process_replica_set_members(members, results, reference_builder, run)
 
 
-def process_indexes(results, conn, server_uri, reference):
+def process_indexes(
+    results,
+    conn,
+    server_uri,
+    reference_builder,
+    run=None,
+    timer=None,
+    is_master=None):
     log.info('In processing indexes for mongod {0}'.format(server_uri))
-    collection_indexes = []
-    for database in conn.database_names():
-        if database in [u'local', u'admin', u'config', u'test']:
-            log.debug(
-                'Skipping processing index for system database {0}'.format(
-                    database))
-            continue
-        indexes = conn[database]['system.indexes'].find().sort(
-            [('ns', 1), ('key', 1)])
-        index_dict = {}
-        ns = None
-        for index in indexes:
-            if not ns:
-                ns = index['ns']
-                log.debug('NS is none. Set to {0}'.format(ns))
-            if ns != index['ns']:
-                log.debug('{0} != {1}'.format(ns, index['ns']))
-                collection_indexes.append({ns: index_dict})
-                ns = index['ns']
-                index_dict = {}
-            index_dict[index['name']] = index['key']
-            if ns not in reference:
-                ns_stats = {'index_count': 0, 'indexes': {}}
-                reference[ns] = ns_stats
-            else:
-                ns_stats = reference[ns]
-            if index['name'] not in ns_stats['indexes']:
-                ns_stats['indexes'][index['name']] = index['key']
-                ns_stats['index_count'] += 1
-        if len(index_dict) > 0:
-            collection_indexes.append({ns: index_dict})
-    results['servers'][server_uri] = collection_indexes
+    run = run or IndexRun()
+    timer = timer or PhaseTimer()
+    pool = run.pool.for_cluster()
+    with pool.slot():
+        if is_master is None:
+            with timer.phase('command'):
+                is_master = conn['admin'].command('isMaster')
+        with timer.phase('list_databases'):
+            databases = conn.database_names()
+    collector = get_collector(is_master)
+    log.debug('Using {0} collector for {1}'.format(
+        collector.name, server_uri))
+    databases = [
+        database for database in databases
+        if database not in [u'local', u'admin', u'config', u'test']]
+    namespaces = {}
+    for database_indexes in pool.map(
+            lambda database: get_database_indexes(
+                conn, database, collector, timer, pool),
+            databases):
+        namespaces.update(database_indexes)
+    collection_indexes = as_namespace_list(namespaces)
+    add_timings(results, server_uri, timer.timings, run)
+
+    def write_spec(fingerprint, index_dict):
+        run.sink.write({'spec': fingerprint, 'indexes': index_dict})
+
+    # Held while new specs are streamed so that no other member can refer
+    # to a spec before its record is written.
+    with results_lock:
+        member = run.specs.fingerprint_member(
+            collection_indexes, run.sink and write_spec)
+        primary = bool(is_master.get('ismaster'))
+        reference_builder.add(member['namespaces'], primary)
+        if run.sink:
+            run.sink.write({
+                'server': server_uri,
+                'namespaces': member['namespaces'],
+                'databases': member['databases'],
+                'primary': primary,
+                'timings': timer.timings
+            })
+        else:
+            run.specs.add_member(server_uri, member)
+
+
+def get_database_indexes(conn, database, collector, timer, pool):
+    with pool.slot():
+        return collector.collect(conn[database], timer)
 
 
 def get_replica_set_members(replica_set_member):
     log.info('Get replica set info for member {0}'.format(replica_set_member))
-    conn = MongoClient(
-        replica_set_member,
-        read_preference=ReadPreference.SECONDARY_PREFERRED)
-    rsconfig = conn['local']['system.replset'].find_one()
+    with lease_client(
+            replica_set_member,
+            read_preference=ReadPreference.SECONDARY_PREFERRED) as conn:
+        rsconfig = conn['local']['system.replset'].find_one()
     if rsconfig:
         return [member['host'] for member in rsconfig['members']]
     else:
         return [replica_set_member]
 
 
-def process_replica_set_members(members, results, reference):
-    for member in members:
-        try:
-            member_conn = MongoClient(
-                member,
-                # connectTimeoutMS=5000,
-                read_preference=ReadPreference.SECONDARY_PREFERRED)
-            is_master = member_conn['admin'].command('isMaster')
+def process_replica_set_members(members, results, reference_builder, run=None):
+    run = run or IndexRun()
+    members = [member for member in members if member not in run.done]
+    run.pool.map(
+        lambda member: process_member(member, results, reference_builder, run),
+        members)
+
+
+def process_member(member, results, reference_builder, run):
+    timer = PhaseTimer()
+    try:
+        member_lease = lease_client(
+            member,
+            # connectTimeoutMS=5000,
+            read_preference=ReadPreference.SECONDARY_PREFERRED)
+        with member_lease as member_conn:
+            with run.pool.slot():
+                # the client connects in the background, the first round
+                # trip waits for it
+                with timer.phase('connect'):
+                    member_conn['admin'].command('ping')
+                with timer.phase('command'):
+                    is_master = member_conn['admin'].command('isMaster')
             if not (is_master['ismaster'] or is_master['secondary']):
                 log.warning('{0} is neither primary or secondary', member)
-                results['errors'][member] = 'Neither primary nor secondary'
+                add_error(
+                    results,
+                    member,
+                    'Neither primary nor secondary',
+                    run,
+                    timer.timings)
                 return
             log.debug('Obtained connection to mongod {0}'.format(member))
-            process_indexes(results, member_conn, member, reference)
-        except Exception, e:
-            log.exception(e)
-            results['errors'][member] = 'Cannot connect'
+            process_indexes(
+                results, member_conn, member, reference_builder, run, timer,
+                is_master)
+    except Exception, e:
+        log.exception(e)
+        add_error(
+            results,
+            member,
+            'Cannot connect: {0}'.format(e),
+            run,
+            timer.timings)
 
 
-def write_raw_output(out_file, results, reference):
+@coroutine
+def raw_output_writer(out_file, results, reference, specs):
     out_file.write('REFERENCE\n')
     out_file.write('---------\n')
     json.dump(reference, out_file, indent=4 * ' ')
     out_file.write('\nSERVER\n')
     out_file.write('------\n')
-    json.dump(results, out_file, indent=4 * ' ')
+    out_file.write('{\n    "errors": ')
+    json.dump(results['errors'], out_file)
+    out_file.write(',\n    "timings": ')
+    json.dump(results.get('timings', {}), out_file)
+    if results.get('changes') is not None:
+        # filled in by the changes collector, closed before this writer
+        try:
+            while True:
+                yield
+        except GeneratorExit:
+            out_file.write(',\n    "changes": ')
+            json.dump(results['changes'], out_file)
+            out_file.write('\n}')
+        return
+    out_file.write(',\n    "servers": {')
+    index = 0
+    try:
+        while True:
+            server_name, member = yield
+            out_file.write(',' if index else '')
+            out_file.write('\n        %s: %s' % (
+                json.dumps(server_name),
+                json.dumps(specs.expand_member(member))))
+            index += 1
+    except GeneratorExit:
+        out_file.write('\n    }\n}')
 
 
-def write_html_output(out_file, header, results, reference):
+@coroutine
+def html_output_writer(out_file, header, results, reference, specs):
     out_file.write('<html>\n')
     out_file.write('\t<head>\n')
     out_file.write('\t\t<title>Indexes for %s</title>\n' % header)
@@ -155,22 +501,35 @@ def write_html_output(out_file, header, results, reference):
                 background-color: white;
                 color: red;
             }
+            .warning {
+                background-color: white;
+                color: orange;
+            }
         </style>""")
     out_file.write('\t</head>\n')
     out_file.write('\t<body>\n')
-    write_output_body(out_file, header, results, reference)
+    out_file.write('\t\t<h1>{0}</h1>\n'.format(header))
+    if results.get('changes') is not None:
+        try:
+            while True:
+                yield
+        except GeneratorExit:
+            write_changes(out_file, results['changes'])
+    else:
+        write_indexes(out_file, reference)
+        write_redundant_indexes(out_file, reference)
+        status_writer = server_status_writer(out_file, reference, specs)
+        try:
+            while True:
+                status_writer.send((yield))
+        except GeneratorExit:
+            status_writer.close()
+    write_errors(out_file, results['errors'])
     out_file.write('\t</body>\n')
     out_file.write('</html>\n')
     out_file.flush()
 
 
-def write_output_body(out_file, header, results, reference):
-    out_file.write('\t\t<h1>{0}</h1>\n'.format(header))
-    write_indexes(out_file, reference)
-    write_server_status(out_file, results['servers'], reference)
-    write_errors(out_file, results['errors'])
-
-
 def write_errors(out_file, errors):
     out_file.write('\t\t<h2>Other errors</h2>\n')
     if len(errors) > 0:
@@ -179,7 +538,7 @@ def write_errors(out_file, errors):
             '\t\t\t<tr><th>Server</th><th>Error</th></tr>\n')
         for server in sorted(errors.iterkeys()):
             out_file.write(
-                '\t\t\t<tr><td>{0}</td><td>{0}</td></tr>\n'.format(
+                '\t\t\t<tr><td>{0}</td><td>{1}</td></tr>\n'.format(
                 server,
                 errors[server]))
         out_file.write('\t\t</table>\n')
@@ -187,14 +546,56 @@ def write_errors(out_file, errors):
         out_file.write('\t\t<p>No other errors on this run.</p>')
 
 
+def write_changes(out_file, changes):
+    out_file.write('\t\t<h2>Changes since snapshot</h2>\n')
+    if not (changes['added'] or changes['removed'] or changes['indexes']):
+        out_file.write('\t\t<p>No changes since the snapshot.</p>\n')
+        return
+    out_file.write('\t\t<table border="1">\n')
+    out_file.write(
+        '\t\t\t<tr><th>Server</th><th>Change</th><th>Namespace</th><th>Index Name</th><th>Key</th><th>Previous Key</th></tr>\n')
+    for server in changes['added']:
+        out_file.write(
+            '\t\t\t<tr><td>%s</td><td colspan="5">MEMBER ADDED</td></tr>\n' %
+            server)
+    for server in changes['removed']:
+        out_file.write(
+            '\t\t\t<tr class="error"><td>%s</td><td colspan="5">MEMBER REMOVED</td></tr>\n' %
+            server)
+    for change in changes['indexes']:
+        rows = [
+            ('ADDED', index_name, index_key, None)
+            for index_name, index_key in change['added']]
+        rows.extend(
+            ('REMOVED', index_name, None, index_key)
+            for index_name, index_key in change['removed'])
+        rows.extend(
+            ('CHANGED', index_name, index_key, previous_key)
+            for index_name, index_key, previous_key in change['changed'])
+        for kind, index_name, index_key, previous_key in rows:
+            out_file.write(
+                '\t\t\t<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n' % (
+                    change['server'],
+                    kind,
+                    change['namespace'],
+                    index_name,
+                    index_key,
+                    previous_key))
+    out_file.write('\t\t</table>\n')
+
+
 def write_indexes(out_file, reference):
     out_file.write('\t\t<h2>Indexes</h2>\n')
     for namespace in sorted(reference.iterkeys()):
         body = reference[namespace]
         log.debug('Namespace=%s, Body=%s', namespace, body)
+        agreement = ''
+        if 'agreement' in body:
+            agreement = ', %.0f%% of %d members agree' % (
+                body['agreement'] * 100, body['members'])
         out_file.write(
-            '\t\t<h3>%s - %d indexes</h3>\n' %
-            (namespace, body['index_count']))
+            '\t\t<h3>%s - %d indexes%s</h3>\n' %
+            (namespace, body['index_count'], agreement))
         out_file.write('\t\t<table border="1">\n')
         out_file.write('\t\t\t<tr><th>Index Name</th><th>Index Key</th></tr>\n')
         for index_name in sorted(body['indexes'].iterkeys()):
@@ -207,70 +608,300 @@ def write_indexes(out_file, reference):
         out_file.write('\t\t</table>\n')
 
 
-def write_server_status(out_file, servers, reference):
+def write_redundant_indexes(out_file, reference):
+    # Duplicate and prefix covered indexes of the reference, the shard key
+    # is not known here so nothing is reported as covered by it
+    out_file.write('\t\t<h2>Redundant indexes</h2>\n')
+    rows = []
+    for namespace in sorted(reference.iterkeys()):
+        indexes = reference[namespace]['indexes']
+        for finding in analyze(indexes):
+            rows.append((
+                namespace,
+                finding['index'],
+                indexes[finding['index']],
+                finding['kind'],
+                finding['covered_by'],
+                indexes[finding['covered_by']]))
+    if not rows:
+        out_file.write('\t\t<p>No redundant indexes.</p>\n')
+        return
+    out_file.write('\t\t<table border="1" class="warning">\n')
+    out_file.write(
+        '\t\t\t<tr><th>Namespace</th><th>Index Name</th><th>Index Key</th><th>Kind</th><th>Covered By</th><th>Covering Key</th></tr>\n')
+    for row in rows:
+        out_file.write(
+            '\t\t\t<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n' % row)
+    out_file.write('\t\t</table>\n')
+
+
+@coroutine
+def server_status_writer(out_file, reference, specs):
+    # Mismatched rows are written in full, VALID servers only counted
     out_file.write('\t\t<h2>Servers</h2>\n')
     out_file.write('\t\t<table border="1">\n')
     out_file.write(
         '\t\t\t<tr><th>Server</th><th>Status</th><th>Namespace</th><th>Source</th><th>Index Name</th><th>Source</th><th>Target</th></tr>\n')
-    for server_name in sorted(servers.keys()):
-        namespaces = servers[server_name]
-        valid = True
-        for collection in namespaces:
-            namespace_name = collection.keys()[0]
-            if namespace_name == "null":
-                log.warning(
-                    'Encountered namespace name null for %s',
-                    server_name)
-                continue
-            if not namespace_name:
-                log.warning(
-                    'Encountered namespace name None for %s',
-                    server_name)
-                continue
-            namespace_indexes = collection.values()[0]
-            log.debug('namespace_name = %s', namespace_name)
-            log.debug('namespace_indexes = %s', namespace_indexes)
-            reference_indexes = reference[namespace_name]['indexes']
-            log.debug('reference_indexes = %s', reference_indexes)
-
-            # Check server indexes against master's
-            for index_name, index_key in namespace_indexes.items():
-                reference_index_key = reference_indexes.get(index_name)
-                if index_key != reference_index_key:
-                    valid = False
-                    out_file.write(
-                        '\t\t\t<tr class="error"><td>%s</td><td>INVALID</td><td>%s</td><td>SERVER</td><td>%s</td><td>%s</td><td>%s</td></tr>\n' % (
-                            server_name,
-                            namespace_name,
-                            index_name,
-                            index_key,
-                            reference_index_key))
-
-            # Check master indexes against server's
-            for index_name, index_key in reference_indexes.items():
-                server_index_key = namespace_indexes.get(index_name)
-                if index_key != server_index_key:
-                    valid = False
-                    out_file.write(
-                        '\t\t\t<tr class="error"><td>%s</td><td>INVALID</td><td>%s</td><td>MASTER</td><td>%s</td><td>%s</td><td>%s</td></tr>\n' % (
-                            server_name,
-                            namespace_name,
-                            index_name,
-                            index_key,
-                            server_index_key))
-
+    differ = IndexDiffer(reference, specs)
+    valid = 0
+    try:
+        while True:
+            server_name, member = yield
+            if write_server_status(
+                    out_file, server_name, differ.diff_member(member)):
+                valid += 1
+    except GeneratorExit:
         if valid:
             out_file.write(
-                '\t\t\t<tr><td>%s</td><td colspan="6">VALID</td></tr>\n' %
+                '\t\t\t<tr><td colspan="7">%d servers VALID</td></tr>\n' %
+                valid)
+        out_file.write('\t\t</table>\n')
+
+
+def write_server_status(out_file, server_name, diffs):
+    valid = True
+    for row in invalid_rows(server_name, diffs):
+        valid = False
+        write_invalid_row(out_file, server_name, *row)
+    return valid
+
+
+def invalid_rows(server_name, diffs):
+    for namespace_name, diff in diffs:
+        if namespace_name == "null":
+            log.warning(
+                'Encountered namespace name null for %s',
                 server_name)
-    out_file.write('\t\t</table>\n')
+            continue
+        if not namespace_name:
+            log.warning(
+                'Encountered namespace name None for %s',
+                server_name)
+            continue
+        log.debug('namespace_name = %s', namespace_name)
+        log.debug('diff = %s', diff)
+
+        # Check server indexes against master's
+        rows = [
+            (index_name, index_key, None)
+            for index_name, index_key in diff['extra']]
+        rows.extend(diff['changed'])
+        for index_name, index_key, reference_index_key in sorted(rows):
+            yield (
+                namespace_name,
+                'SERVER',
+                index_name,
+                index_key,
+                reference_index_key)
+
+        # Check master indexes against server's
+        rows = [
+            (index_name, index_key, None)
+            for index_name, index_key in diff['missing']]
+        rows.extend(
+            (index_name, reference_index_key, index_key)
+            for index_name, index_key, reference_index_key
+            in diff['changed'])
+        for index_name, index_key, server_index_key in sorted(rows):
+            yield (
+                namespace_name,
+                'MASTER',
+                index_name,
+                index_key,
+                server_index_key)
+
+
+@coroutine
+def paged_html_writer(report, results, reference, specs):
+    # One page per database with its reference indexes and mismatched rows.
+    # Only the mismatched rows are held until the last member, VALID
+    # servers are counted on the index page.
+    if results.get('changes') is not None:
+        try:
+            while True:
+                yield
+        except GeneratorExit:
+            write_changes(report.index, results['changes'])
+            write_errors(report.index, results['errors'])
+            report.close()
+        return
+    differ = IndexDiffer(reference, specs)
+    rows = {}
+    invalid = {}
+    valid = 0
+    try:
+        while True:
+            server_name, member = yield
+            namespaces = set()
+            for row in invalid_rows(
+                    server_name, differ.diff_member(member)):
+                namespaces.add(row[0])
+                rows.setdefault(database_name(row[0]), []).append(
+                    (server_name,) + row)
+            if namespaces:
+                invalid[server_name] = len(namespaces)
+            else:
+                valid += 1
+    except GeneratorExit:
+        write_paged_report(report, reference, rows, invalid, valid)
+        write_errors(report.index, results['errors'])
+        report.close()
+
+
+def write_paged_report(report, reference, rows, invalid, valid):
+    out_file = report.index
+    out_file.write('\t\t<h2>Servers</h2>\n')
+    out_file.write('\t\t<p>%d of %d servers VALID</p>\n' % (
+        valid, valid + len(invalid)))
+    if invalid:
+        out_file.write('\t\t<table border="1" class="error">\n')
+        out_file.write(
+            '\t\t\t<tr><th>Server</th><th>Mismatched namespaces</th></tr>\n')
+        for server_name in sorted(invalid):
+            out_file.write('\t\t\t<tr><td>%s</td><td>%d</td></tr>\n' % (
+                server_name, invalid[server_name]))
+        out_file.write('\t\t</table>\n')
+    databases = {}
+    for namespace in reference:
+        databases.setdefault(database_name(namespace), {})[namespace] = (
+            reference[namespace])
+    out_file.write('\t\t<h2>Databases</h2>\n')
+    out_file.write('\t\t<ul>\n')
+    for database in sorted(set(databases) | set(rows)):
+        namespaces = databases.get(database, {})
+        database_rows = rows.pop(database, [])
+        summary = '%d namespaces, %d mismatched rows' % (
+            len(namespaces), len(database_rows))
+        with report.page(database, summary) as page:
+            write_indexes(page, namespaces)
+            write_redundant_indexes(page, namespaces)
+            page.write('\t\t<h2>Mismatches</h2>\n')
+            page.write('\t\t<table border="1">\n')
+            page.write(
+                '\t\t\t<tr><th>Server</th><th>Status</th><th>Namespace</th><th>Source</th><th>Index Name</th><th>Source</th><th>Target</th></tr>\n')
+            for row in sorted(database_rows):
+                write_invalid_row(page, *row)
+            page.write('\t\t</table>\n')
+    out_file.write('\t\t</ul>\n')
+
+
+def write_invalid_row(
+    out_file, server_name, namespace_name, source, index_name, key, target):
+    out_file.write(
+        '\t\t\t<tr class="error"><td>%s</td><td>INVALID</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n' % (
+            server_name,
+            namespace_name,
+            source,
+            index_name,
+            key,
+            target))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('mongos_uri', help='URL of mongos')
+    parser.add_argument(
+        'mongos_uri',
+        help='URL of mongos, or of the monitoring database with --daemon')
     parser.add_argument('output_file', help='File contain output result')
     parser.add_argument('--simulate', action='store_true')
+    parser.add_argument(
+        '--dataset',
+        help='Dataset written by sample_dataset.py that --simulate uses '
+        'instead of sample_index_results')
     parser.add_argument('--output_json', action='store_true')
+    parser.add_argument(
+        '--html_pages',
+        help='Write <output_file>.html as an index with one page per '
+        'database under <output_file>_pages',
+        action='store_true')
+    parser.add_argument(
+        '--replay',
+        help='Stream file of an earlier run (<output_file>.ndjson) the '
+        'reports are rebuilt from without connecting to any server')
+    parser.add_argument(
+        '--monitoring_uri',
+        help='Monitoring database URI used to cache discovered topologies')
+    parser.add_argument(
+        '--topology_ttl',
+        help='Seconds a discovered topology is reused, 0 disables the '
+        'cache, at most %d' % TOPOLOGY_CACHE_MAX_TTL_SECONDS,
+        type=int,
+        default=TOPOLOGY_CACHE_TTL_SECONDS)
+    parser.add_argument(
+        '--stream_file',
+        help='NDJSON file members are appended to, defaults to '
+        '<output_file>.ndjson')
+    parser.add_argument(
+        '--resume',
+        help='Skip members already in the stream file',
+        action='store_true')
+    parser.add_argument(
+        '--daemon',
+        help='Keep running and check every live monitoring_hosts cluster '
+        'on its own interval',
+        action='store_true')
+    parser.add_argument(
+        '--max_clients',
+        help='Maximum number of open MongoClients',
+        type=int,
+        default=DEFAULT_MAX_CLIENTS)
+    parser.add_argument(
+        '--concurrency',
+        help='Maximum number of members read at the same time',
+        type=int,
+        default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        '--database_concurrency',
+        help='Maximum number of databases of one member read at the same '
+        'time',
+        type=int,
+        default=DEFAULT_DATABASE_CONCURRENCY)
+    parser.add_argument(
+        '--reference_mode',
+        help='How the reference indexes are chosen: held by a majority of '
+        'the members, seen on any member, or held by the primaries',
+        choices=REFERENCE_MODES,
+        default=DEFAULT_REFERENCE_MODE)
+    parser.add_argument(
+        '--snapshot',
+        help='File the index fingerprints and specs of this run are saved '
+        'to')
+    parser.add_argument(
+        '--since',
+        help='Snapshot file of an earlier run, only the changes since then '
+        'are reported')
+    parser.add_argument(
+        '--prometheus_file',
+        help='Prometheus textfile the per phase probe timings are '
+        'written to')
     args = parser.parse_args()
-    main(args.mongos_uri, args.output_file, args.simulate, args.output_json)
+    registry.max_clients = args.max_clients
+    if args.daemon:
+        run_daemon(
+            args.mongos_uri,
+            args.output_file,
+            args.output_json,
+            args.topology_ttl,
+            args.prometheus_file,
+            args.concurrency,
+            args.database_concurrency,
+            args.reference_mode)
+    else:
+        main(
+            args.mongos_uri,
+            args.output_file,
+            args.simulate,
+            args.output_json,
+            args.monitoring_uri,
+            args.topology_ttl,
+            args.stream_file,
+            args.resume,
+            args.prometheus_file,
+            args.concurrency,
+            args.database_concurrency,
+            args.reference_mode,
+            args.snapshot,
+            args.since,
+            args.dataset,
+            args.html_pages,
+            args.replay)
@@ -0,0 +1,109 @@
+import heapq
+import logging
+import random
+import time
+
+DEFAULT_INTERVAL_SECONDS = 3600
+DEFAULT_JITTER = 0.1
+DEFAULT_REFRESH_SECONDS = 300
+
+log = logging.getLogger('cluster_scheduler')
+
+
+class ClusterScheduler(object):
+    # Timer heap over the live monitoring_hosts documents. Each cluster is
+    # checked every <interval_field> seconds (falling back to
+    # interval_seconds), shifted by up to +/- jitter of the interval so the
+    # clusters do not all fire at the same moment.
+
+    def __init__(
+        self,
+        interval_field='interval_seconds',
+        jitter=DEFAULT_JITTER,
+        clock=time.time,
+        sleep=time.sleep):
+        self.interval_field = interval_field
+        self.jitter = jitter
+        self.clock = clock
+        self.sleep = sleep
+        self._heap = []
+        self._clusters = {}
+        self._sequence = 0
+
+    def interval(self, seed_host):
+        return seed_host.get(
+            self.interval_field,
+            seed_host.get('interval_seconds', DEFAULT_INTERVAL_SECONDS))
+
+    def _push(self, label, due):
+        self._sequence += 1
+        generation = self._clusters[label][1]
+        heapq.heappush(self._heap, (due, self._sequence, label, generation))
+
+    def update(self, seed_hosts):
+        now = self.clock()
+        seen = set()
+        for seed_host in seed_hosts:
+            label = seed_host['_id']
+            seen.add(label)
+            if label in self._clusters:
+                self._clusters[label] = (seed_host, self._clusters[label][1])
+                continue
+            log.info('Scheduling {0}'.format(label))
+            self._clusters[label] = (seed_host, self._sequence)
+            # spread the first checks over one jitter window
+            self._push(label, now + random.uniform(
+                0, self.jitter * self.interval(seed_host)))
+        for label in set(self._clusters) - seen:
+            log.info('Unscheduling {0}'.format(label))
+            del self._clusters[label]
+
+    def labels(self):
+        return set(self._clusters)
+
+    def next_due(self):
+        while self._heap:
+            due, _, label, generation = self._heap[0]
+            cluster = self._clusters.get(label)
+            if cluster and cluster[1] == generation:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self):
+        now = self.clock()
+        due_hosts = []
+        while True:
+            due = self.next_due()
+            if due is None or due > now:
+                break
+            _, _, label, _ = heapq.heappop(self._heap)
+            seed_host = self._clusters[label][0]
+            due_hosts.append(seed_host)
+            interval = self.interval(seed_host)
+            self._push(label, now + interval * (
+                1 + random.uniform(-self.jitter, self.jitter)))
+        return due_hosts
+
+    def run(self, load, check, refresh_seconds=DEFAULT_REFRESH_SECONDS):
+        next_refresh = self.clock()
+        while True:
+            if self.clock() >= next_refresh:
+                try:
+                    self.update(load())
+                except Exception:
+                    log.exception('Error loading monitoring hosts')
+                next_refresh = self.clock() + refresh_seconds
+            due_hosts = self.pop_due()
+            if due_hosts:
+                try:
+                    check(due_hosts)
+                except Exception:
+                    log.exception('Error checking {0}'.format(
+                        [seed_host['_id'] for seed_host in due_hosts]))
+                continue
+            wake = next_refresh
+            due = self.next_due()
+            if due is not None:
+                wake = min(wake, due)
+            self.sleep(max(0, wake - self.clock()))
@@ -0,0 +1,557 @@
+from collections import Counter, OrderedDict
+import datetime
+import random
+import threading
+import time
+import zlib
+
+from bson.son import SON
+from pymongo.errors import (
+    InvalidOperation, NetworkTimeout, OperationFailure,
+    ServerSelectionTimeoutError)
+
+from index_collectors import LIST_CATALOG_WIRE_VERSION
+from mongo_connections import DEFAULT_PORT
+from mongo_setup import MONITORING_DB, MONITORING_HOSTS
+
+# Hosts are loopback addresses so that resolving them (host_identity) is
+# instant, host names that do not resolve would time the DNS resolver.
+MONITORING_HOST = '127.0.0.1:27017'
+CONFIG_PORT = 27019
+DEFAULT_VERSION = '3.6.8'
+DEFAULT_WIRE_VERSION = 6
+DEFAULT_TIMEOUT_SECONDS = 0.5
+STARTED = datetime.datetime(2026, 1, 1)
+
+
+def split_hosts(uri):
+    if '://' in uri:
+        uri = uri.split('://', 1)[1]
+    uri = uri.split('/', 1)[0].split('@')[-1]
+    hosts = []
+    for host in uri.split(','):
+        if ':' not in host:
+            host = '{0}:{1}'.format(host, DEFAULT_PORT)
+        hosts.append(host.lower())
+    return hosts
+
+
+def matches(document, query):
+    # Equality and $in only, other operators are treated as matching
+    for field, value in (query or {}).items():
+        if isinstance(value, dict) and '$in' in value:
+            if document.get(field) not in value['$in']:
+                return False
+            continue
+        if isinstance(value, dict) and any(
+                name.startswith('$') for name in value):
+            continue
+        if document.get(field) != value:
+            return False
+    return True
+
+
+def decode(value, document_class=dict):
+    # A stored document as the driver hands it back, every embedded document
+    # rebuilt as document_class. Into a plain dict Python 2 loses the field
+    # order of compound keys just like BSON decoding does.
+    if isinstance(value, dict):
+        return document_class(
+            (key, decode(item, document_class))
+            for key, item in value.items())
+    if isinstance(value, list):
+        return [decode(item, document_class) for item in value]
+    return value
+
+
+def document_class(codec_options):
+    return codec_options.document_class if codec_options else dict
+
+
+class FakeNode(object):
+
+    def __init__(self, host, kind, set_name=None, primary=False):
+        self.host = host
+        self.kind = kind
+        self.set_name = set_name
+        self.primary = primary
+        self.latency = None
+        self.dead = False
+        self.hangs = False
+        # {ns: {name: key}} replacing the catalog indexes on this node
+        self.drift = {}
+
+
+class FakeTopology(object):
+    # In process stand-in for a sharded cluster and its monitoring database.
+    # Every command, query and handshake is a round trip that sleeps the
+    # latency of its node. Dead nodes fail server selection and hanging
+    # nodes time out, both after timeout seconds.
+    #
+    # Installed through mongo_connections.registry.factory = topology.client
+
+    def __init__(
+        self,
+        shards=2,
+        members=3,
+        mongos=2,
+        configs=3,
+        databases=3,
+        collections=5,
+        indexes=4,
+        latency=0.0,
+        timeout=DEFAULT_TIMEOUT_SECONDS,
+        version=DEFAULT_VERSION,
+        wire_version=DEFAULT_WIRE_VERSION,
+        drift=0.0,
+        seed=0):
+        self.latency = latency
+        self.timeout = timeout
+        self.version = version
+        self.wire_version = wire_version
+        self.nodes = OrderedDict()
+        self.shards = []
+        self.mongos = []
+        self.configs = []
+        self.catalog = {}
+        self.shard_keys = {}
+        # namespaces of the catalog that are time-series collections
+        self.timeseries = set()
+        self._add(FakeNode(MONITORING_HOST, 'monitoring'))
+        for index in xrange(mongos):
+            host = '127.1.{0}.{1}:{2}'.format(
+                index // 250, index % 250 + 1, DEFAULT_PORT)
+            self.mongos.append(self._add(FakeNode(host, 'mongos')).host)
+        for index in xrange(configs):
+            host = '127.2.0.{0}:{1}'.format(index + 1, CONFIG_PORT)
+            self.configs.append(self._add(
+                FakeNode(host, 'config', 'configrs', index == 0)).host)
+        for shard in xrange(shards):
+            set_name = 'shard{0}'.format(shard)
+            hosts = []
+            for member in xrange(members):
+                host = '127.{0}.{1}.{2}:{3}'.format(
+                    member + 3, shard // 250, shard % 250 + 1, DEFAULT_PORT)
+                hosts.append(self._add(
+                    FakeNode(host, 'shard', set_name, member == 0)).host)
+            self.shards.append((set_name, hosts))
+        for database in xrange(databases):
+            db_name = 'db{0}'.format(database)
+            self.catalog[db_name] = {}
+            for collection in xrange(collections):
+                coll_name = 'coll{0}'.format(collection)
+                specs = {'_id_': {'_id': 1}}
+                for field in xrange(1, indexes):
+                    specs['f{0}_1'.format(field)] = {'f{0}'.format(field): 1}
+                self.catalog[db_name][coll_name] = specs
+                namespace = '{0}.{1}'.format(db_name, coll_name)
+                if collection % 4 == 2:
+                    # compound, in an order neither sorting nor a Python 2
+                    # dict keeps
+                    self.shard_keys[namespace] = SON([('f2', 1), ('f1', 1)])
+                    specs['f2_1_f1_1'] = self.shard_keys[namespace]
+                elif collection % 2 == 0:
+                    self.shard_keys[namespace] = {'f1': 1}
+        rng = random.Random(seed)
+        for _, hosts in self.shards:
+            for host in hosts:
+                for db_name, colls in self.catalog.items():
+                    for coll_name, specs in colls.items():
+                        if rng.random() < drift:
+                            specs = dict(specs)
+                            specs['drift_1'] = {'drift': 1}
+                            self.nodes[host].drift[
+                                '{0}.{1}'.format(db_name, coll_name)] = specs
+        self.monitoring_hosts = [{
+            '_id': 'fake',
+            'hosts': ','.join(self.mongos),
+            'live': True,
+            'process_mongos': True
+        }]
+        self.topology_cache = {}
+        self.clients = 0
+        self.connections = 0
+        self.round_trips = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def with_nodes(cls, nodes, members=3, mongos=2, configs=3, **kwargs):
+        shards = max(1, -(-(nodes - mongos - configs) // members))
+        return cls(shards, members, mongos, configs, **kwargs)
+
+    def _add(self, node):
+        self.nodes[node.host] = node
+        return node
+
+    def node_count(self):
+        return len(self.nodes) - 1
+
+    def kill(self, host):
+        self.nodes[host].dead = True
+
+    def hang(self, host):
+        self.nodes[host].hangs = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'nodes': self.node_count(),
+                'clients': self.clients,
+                'connections': self.connections,
+                'round_trips': sum(self.round_trips.values())
+            }
+
+    def client(self, uri, **options):
+        with self._lock:
+            self.clients += 1
+        return FakeClient(self, split_hosts(uri))
+
+    def round_trip(self, host, operation):
+        node = self.nodes.get(host)
+        if node is None or node.dead:
+            time.sleep(self.timeout)
+            raise ServerSelectionTimeoutError(
+                '{0}: [Errno 111] Connection refused'.format(host))
+        if node.hangs:
+            time.sleep(self.timeout)
+            raise NetworkTimeout('{0}: timed out'.format(host))
+        with self._lock:
+            self.round_trips[operation] += 1
+        latency = self.latency if node.latency is None else node.latency
+        if latency:
+            time.sleep(latency)
+        return node
+
+    def indexes(self, node, db_name):
+        specs = []
+        for coll_name, indexes in sorted(self.catalog[db_name].items()):
+            namespace = '{0}.{1}'.format(db_name, coll_name)
+            indexes = node.drift.get(namespace, indexes)
+            for name, key in sorted(indexes.items()):
+                specs.append({'v': 1, 'ns': namespace, 'name': name, 'key': key})
+        return specs
+
+    def collection_type(self, db_name, coll_name):
+        namespace = '{0}.{1}'.format(db_name, coll_name)
+        return 'timeseries' if namespace in self.timeseries else 'collection'
+
+    def is_master(self, node):
+        reply = {
+            'ok': 1.0,
+            'maxWireVersion': self.wire_version,
+            'ismaster': node.kind in ('mongos', 'monitoring') or node.primary,
+            'secondary': False
+        }
+        if node.kind == 'mongos':
+            reply['msg'] = 'isdbgrid'
+        elif node.set_name:
+            reply['setName'] = node.set_name
+            reply['setVersion'] = 1
+            reply['secondary'] = not node.primary
+            reply['hosts'] = self.replica_set(node)
+        return reply
+
+    def replica_set(self, node):
+        if node.kind == 'config':
+            return list(self.configs)
+        return dict(self.shards).get(node.set_name, [])
+
+    def command(self, node, db_name, command):
+        name = command if isinstance(command, basestring) else (
+            command.keys()[0])
+        if name == 'ping':
+            return {'ok': 1.0}
+        if name == 'isMaster':
+            return self.is_master(node)
+        if name == 'buildInfo':
+            return {'ok': 1.0, 'version': self.version}
+        if name == 'serverStatus':
+            return {
+                'ok': 1.0,
+                'process': 'mongos' if node.kind == 'mongos' else 'mongod',
+                'version': self.version,
+                'host': node.host
+            }
+        if name == 'getCmdLineOpts' and node.kind == 'mongos':
+            return {'ok': 1.0, 'parsed': {
+                'configdb': 'configrs/' + ','.join(self.configs)}}
+        if name == 'listDatabases':
+            return {'ok': 1.0, 'databases': [
+                {'name': database, 'empty': False}
+                for database in self.database_names(node)]}
+        raise OperationFailure('no such command: {0}'.format(name))
+
+    def database_names(self, node):
+        if node.kind == 'monitoring':
+            return ['admin', MONITORING_DB]
+        if node.kind == 'config':
+            return ['admin', 'config', 'local']
+        names = ['admin', 'config'] + sorted(self.catalog)
+        if node.kind == 'shard':
+            names.append('local')
+        return names
+
+    def documents(self, node, db_name, coll_name):
+        if db_name == MONITORING_DB and coll_name == MONITORING_HOSTS:
+            return self.monitoring_hosts
+        if db_name == MONITORING_DB:
+            return self.topology_cache.values()
+        if db_name == 'config' and coll_name == 'shards':
+            return [
+                {'_id': set_name, 'host': set_name + '/' + ','.join(hosts)}
+                for set_name, hosts in self.shards]
+        if db_name == 'config' and coll_name == 'mongos':
+            return [{'_id': host} for host in self.mongos]
+        if db_name == 'config' and coll_name == 'databases':
+            return [
+                {'_id': database, 'partitioned': True, 'primary': 'shard0'}
+                for database in sorted(self.catalog)]
+        if db_name == 'config' and coll_name == 'collections':
+            return [
+                {'_id': namespace, 'key': key, 'dropped': False}
+                for namespace, key in sorted(self.shard_keys.items())]
+        if db_name == 'local' and coll_name == 'system.replset':
+            if not node.set_name:
+                return []
+            return [{
+                '_id': node.set_name,
+                'members': [
+                    {'_id': index, 'host': host}
+                    for index, host in enumerate(self.replica_set(node))]
+            }]
+        if coll_name == 'system.indexes' and db_name in self.catalog:
+            return self.indexes(node, db_name)
+        return []
+
+
+class FakeCursor(list):
+
+    def sort(self, key_or_list, direction=None):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction or 1)]
+        for field, order in reversed(key_or_list):
+            list.sort(
+                self,
+                key=lambda document: document.get(field),
+                reverse=order < 0)
+        return self
+
+
+class FakeCollection(object):
+
+    def __init__(self, database, name, codec_options=None):
+        self.database = database
+        self.name = name
+        self.codec_options = codec_options or database.codec_options
+
+    def _decode(self, document):
+        return decode(document, document_class(self.codec_options))
+
+    def _documents(self, operation):
+        client = self.database.client
+        node = client._round_trip(operation)
+        return client._topology.documents(node, self.database.name, self.name)
+
+    def find(self, filter=None, projection=None, **kwargs):
+        return FakeCursor(
+            self._decode(document) for document in self._documents('find')
+            if matches(document, filter))
+
+    def find_one(self, filter=None, *args, **kwargs):
+        for document in self._documents('find'):
+            if matches(document, filter):
+                return self._decode(document)
+        return None
+
+    def replace_one(self, filter, replacement, upsert=False):
+        self.database.client._round_trip('update')
+        topology = self.database.client._topology
+        topology.topology_cache[replacement['_id']] = replacement
+
+    def _indexes(self):
+        client = self.database.client
+        node = client._round_trip('listIndexes')
+        namespace = '{0}.{1}'.format(self.database.name, self.name)
+        return [
+            index for index in client._topology.indexes(
+                node, self.database.name)
+            if index['ns'] == namespace]
+
+    def list_indexes(self):
+        # the driver decodes listIndexes into SON whatever the codec
+        return FakeCursor(decode(index, SON) for index in self._indexes())
+
+    def aggregate(self, pipeline, **kwargs):
+        # Only $indexStats. The highest numbered field index is never used,
+        # the others a stable number of times per node.
+        if '$indexStats' not in pipeline[0]:
+            raise OperationFailure('Unrecognized pipeline stage')
+        indexes = self._indexes()
+        node = self.database.client._select()
+        unused = 'f{0}_1'.format(
+            max(len(indexes) - 1, 1)) if indexes else None
+        return FakeCursor(self._decode({
+            'name': index['name'],
+            'key': index['key'],
+            'host': node.host,
+            'accesses': {
+                'ops': 0 if index['name'] == unused else zlib.crc32(
+                    node.host + index['ns'] + index['name']) % 1000 + 1,
+                'since': STARTED
+            }
+        }) for index in indexes)
+
+    def index_information(self):
+        return dict(
+            (index['name'], {'key': index['key'].items(), 'v': 1})
+            for index in self._indexes())
+
+
+class FakeDatabase(object):
+
+    def __init__(self, client, name, codec_options=None):
+        self.client = client
+        self.name = name
+        self.codec_options = codec_options
+
+    def __getitem__(self, name):
+        return FakeCollection(self, name)
+
+    def get_collection(self, name, codec_options=None, **kwargs):
+        return FakeCollection(self, name, codec_options)
+
+    def command(self, command, *args, **kwargs):
+        node = self.client._round_trip('command')
+        return self.client._topology.command(node, self.name, command)
+
+    def _collection_names(self):
+        node = self.client._round_trip('listCollections')
+        return sorted(
+            self.client._topology.catalog.get(self.name, {})
+            if node.kind in ('mongos', 'shard') else [])
+
+    def list_collections(self, filter=None, **kwargs):
+        return FakeCursor(
+            {'name': name, 'type': self.client._topology.collection_type(
+                self.name, name)}
+            for name in self._collection_names())
+
+    def collection_names(self, include_system_collections=True):
+        return self._collection_names()
+
+    def aggregate(self, pipeline, **kwargs):
+        # Only $listCatalog followed by a $match. A time-series collection
+        # has no indexes of its own, its bucket collection holds them with
+        # the keys rewritten.
+        node = self.client._round_trip('aggregate')
+        topology = self.client._topology
+        if (self.name != 'admin' or '$listCatalog' not in pipeline[0] or
+                topology.wire_version < LIST_CATALOG_WIRE_VERSION):
+            raise OperationFailure('Unrecognized pipeline stage')
+        entries = []
+        if node.kind in ('mongos', 'shard'):
+            for db_name, colls in sorted(topology.catalog.items()):
+                specs = topology.indexes(node, db_name)
+                for coll_name in sorted(colls):
+                    namespace = '{0}.{1}'.format(db_name, coll_name)
+                    indexes = [
+                        {'spec': spec} for spec in specs
+                        if spec['ns'] == namespace]
+                    if namespace in topology.timeseries:
+                        entries.append({
+                            'db': db_name,
+                            'name': coll_name,
+                            'type': 'timeseries'
+                        })
+                        coll_name = 'system.buckets.' + coll_name
+                        indexes = [{'spec': dict(
+                            index['spec'],
+                            key=SON(
+                                ('control.min.' + field, direction)
+                                for field, direction in
+                                index['spec']['key'].items()))}
+                            for index in indexes]
+                    entries.append({
+                        'db': db_name,
+                        'name': coll_name,
+                        'type': 'collection',
+                        'md': {'indexes': indexes}
+                    })
+        query = pipeline[1].get('$match') if len(pipeline) > 1 else None
+        return FakeCursor(
+            decode(entry, document_class(self.codec_options))
+            for entry in entries if matches(entry, query))
+
+
+class FakeClient(object):
+
+    def __init__(self, topology, hosts):
+        self._topology = topology
+        self._hosts = hosts
+        self._node = None
+        self._lock = threading.Lock()
+
+    def _select(self):
+        # The first reachable seed host, the handshake is one round trip
+        with self._lock:
+            if self._node is not None:
+                return self._node
+            errors = []
+            for host in self._hosts:
+                try:
+                    node = self._topology.round_trip(host, 'handshake')
+                except (NetworkTimeout, ServerSelectionTimeoutError) as e:
+                    errors.append(str(e))
+                    continue
+                with self._topology._lock:
+                    self._topology.connections += 1
+                self._node = node
+                return node
+            raise ServerSelectionTimeoutError(', '.join(errors))
+
+    def _round_trip(self, operation):
+        return self._topology.round_trip(self._select().host, operation)
+
+    @property
+    def address(self):
+        # As the driver: a single seed is waited for, a list of seeds is
+        # None until a server was selected and raises once it turns out to
+        # be mongoses
+        if len(self._hosts) == 1:
+            node = self._select()
+        else:
+            node = self._node
+            if node is None:
+                return None
+            if node.kind == 'mongos':
+                raise InvalidOperation(
+                    'Cannot use "address" property when load balancing '
+                    'among mongoses, use "nodes" instead.')
+        host, port = node.host.rsplit(':', 1)
+        return host, int(port)
+
+    @property
+    def nodes(self):
+        if self._node is None:
+            return frozenset()
+        return frozenset(
+            (host, int(port)) for host, port in (
+                host.rsplit(':', 1) for host in self._hosts))
+
+    @property
+    def is_mongos(self):
+        return self._select().kind == 'mongos'
+
+    def database_names(self):
+        node = self._round_trip('command')
+        return self._topology.database_names(node)
+
+    def __getitem__(self, name):
+        return FakeDatabase(self, name)
+
+    def get_database(self, name, codec_options=None, **options):
+        return FakeDatabase(self, name, codec_options)
+
+    def close(self):
+        with self._lock:
+            self._node = None
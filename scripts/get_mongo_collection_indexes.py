@@ -5,87 +5,235 @@ import csv
 from distutils.version import StrictVersion
 import json
 import logging
+import Queue
 # import re
+import threading
 
-from pymongo import MongoClient
+from bson.codec_options import CodecOptions
+from bson.son import SON
+from pymongo.errors import ServerSelectionTimeoutError
 
-from mongo_setup import MONITORING_DB, MONITORING_HOSTS, CONNECTION_TIMEOUT_MS
+from index_collectors import get_collector
+from index_redundancy import analyze, redundant_indexes, write_redundant
+from index_usage import collect_usage, drop_candidates, write_drop_candidates
+from mongo_connections import lease_client, registry
+from mongo_setup import MONITORING_DB, CONNECTION_TIMEOUT_MS, live_hosts
+from probe_pool import ProbePool, DEFAULT_CONCURRENCY
+from probe_timing import PhaseTimer, TimingCollector
+from shard_key_analysis import analyze as analyze_shard_key
+from shard_key_analysis import shard_key_rows, write_shard_keys
 EXCLUDED_DATABASES = { 'admin', 'config', 'test'}
+DEFAULT_DATABASE_CONCURRENCY = 4
+# pymongo gives up on server selection after 30 seconds
+SEED_TIMEOUT_SECONDS = 60
+SEED_OPTIONS = {'connectTimeoutMS': CONNECTION_TIMEOUT_MS, 'slaveOk': True}
 
 
 logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
 log = logging.getLogger('check_mongo_config')
 
 
-def main(mongo_uri, output_file):
-    conn = MongoClient(mongo_uri, connectTimeoutMS=CONNECTION_TIMEOUT_MS)
-    final_results = {}
-    for seed_host in conn[MONITORING_DB][MONITORING_HOSTS].find().sort([('live', 1), 
-        ('_id', 1)]):
+def main(
+    mongo_uri,
+    output_file,
+    prometheus_file=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    database_concurrency=DEFAULT_DATABASE_CONCURRENCY,
+    index_usage=False,
+    drop_candidate_ops=0):
+    with lease_client(
+            mongo_uri, connectTimeoutMS=CONNECTION_TIMEOUT_MS) as conn:
+        seed_hosts = list(live_hosts(conn[MONITORING_DB]))
+    timings = TimingCollector()
+    pool = ProbePool(concurrency, database_concurrency)
+    clusters = []
+    for seed_host in seed_hosts:
         label = seed_host['_id']
-        live = seed_host.get('live', False)
-        log.info('Processing server {0}'.format(label))
-        if not live:
-            log.warning('Skipping {0} since it is not live'.format(label))
-            continue
         hosts = seed_host.get('hosts')
-        skip_mongos = not seed_host.get('process_mongos', True)
         if not hosts:
             log.warning('Skipping {0} since no hosts specified'.format(label))
             continue
-        if isinstance(hosts, basestring):
-            final_results[label] = process(hosts)
+        if not isinstance(hosts, (basestring, list)):
+            log.warning('Skipping {0} as hosts incorrectly specified'.format(label))
+            continue
+        clusters.append((label, hosts))
+
+    def run_cluster(cluster):
+        label, hosts = cluster
+        log.info('Processing server {0}'.format(label))
+        try:
+            return label, process(
+                hosts, timings, label, pool.for_cluster(), index_usage)
+        except Exception as e:
+            log.error('Error processing {0}: {1}: {2}'.format(
+                label, type(e).__name__, e))
+            return label, None
+
+    final_results = {}
+    for label, databases in pool.map(run_cluster, clusters):
+        if databases is not None:
+            final_results[label] = databases
     json_file = output_file + '.json'
     with open(json_file, 'w') as fp:
         json.dump(final_results, fp)
     output_excel(final_results, output_file+'.xls')
+    write_redundant(
+        output_file+'_redundant.xls', redundant_indexes(final_results))
+    write_shard_keys(
+        output_file+'_shard_keys.xls', shard_key_rows(final_results))
+    if index_usage:
+        write_drop_candidates(
+            output_file+'_drop_candidates.xls',
+            drop_candidates(final_results, drop_candidate_ops))
+    if prometheus_file:
+        timings.write_textfile(prometheus_file)
+    log.info('Connection registry stats {0}'.format(registry.stats()))
+
+
+def connect_first(seeds):
+    # Connects to every seed at once and returns the first one to answer,
+    # the slower connections finish in the background. Its client stays
+    # in the registry for the caller to lease.
+    answers = Queue.Queue()
+
+    def connect(seed):
+        try:
+            with lease_client(seed, **SEED_OPTIONS) as conn:
+                # address does not wait for a list of seeds, a round trip
+                # does
+                conn['admin'].command('ping')
+            answers.put((seed, None))
+        except Exception as e:
+            answers.put((seed, e))
 
+    for seed in seeds:
+        thread = threading.Thread(target=connect, args=(seed,))
+        thread.daemon = True
+        thread.start()
+    errors = []
+    for _ in seeds:
+        try:
+            seed, error = answers.get(True, SEED_TIMEOUT_SECONDS)
+        except Queue.Empty:
+            break
+        if error is None:
+            return seed
+        errors.append('{0}: {1}'.format(seed, error))
+    raise ServerSelectionTimeoutError(
+        'No seed answered: {0}'.format('; '.join(errors) or 'timed out'))
 
-def process(server_uri):
+
+def process(hosts, timings=None, label=None, pool=None, index_usage=False):
+    pool = pool or ProbePool(1)
+    if isinstance(hosts, basestring):
+        hosts = [hosts]
     databases = {}
-    # try:
-    conn = MongoClient(server_uri, connectTimeoutMS=CONNECTION_TIMEOUT_MS, slaveOk=True)
-    log.debug('Obtained connection to {0}'.format(server_uri))
-    result = conn['admin'].command('listDatabases')
-    for database in result['databases']:
-        db_name = database.get('name')
-        if database.get('empty'):
-            log.debug('Skipping {0} for {1}'.format(db_name, server_uri))
-        else:
-            if db_name not in EXCLUDED_DATABASES:
-                databases[db_name] = process_database(conn, database.get('name'))
-    return databases
-    # except Exception, e:
-    #     print e
-    #     return {'error' : server_uri}
-
-
-def process_database(conn, db_name):
+    timer = PhaseTimer()
+    with timer.phase('connect'):
+        server_uri = connect_first(hosts)
+    with lease_client(server_uri, **SEED_OPTIONS) as conn:
+        log.debug('Obtained connection to {0}'.format(server_uri))
+        with pool.slot():
+            with timer.phase('command'):
+                result = conn['admin'].command('listDatabases')
+                collector = get_collector(conn['admin'].command('isMaster'))
+            with timer.phase('catalog'):
+                catalog = load_sharding_catalog(conn)
+        db_names = []
+        for database in result['databases']:
+            db_name = database.get('name')
+            if database.get('empty'):
+                log.debug('Skipping {0} for {1}'.format(db_name, server_uri))
+            elif db_name not in EXCLUDED_DATABASES:
+                db_names.append(db_name)
+
+        def crawl(db_name):
+            db_timer = PhaseTimer()
+            with db_timer.phase('discovery'):
+                try:
+                    output = process_database(conn, db_name, catalog, collector, db_timer, pool)
+                except Exception as e:
+                    log.warning('Error processing {0} on {1}: {2}: {3}'.format(
+                        db_name, server_uri, type(e).__name__, e))
+                    output = {
+                        'sharded': catalog['databases'].get(db_name, False),
+                        'collections': [],
+                        'error': '{0}: {1}'.format(type(e).__name__, e)
+                    }
+            output['timings'] = db_timer.timings
+            return db_name, output
+
+        for db_name, output in pool.map(crawl, db_names):
+            databases[db_name] = output
+            timer.timings['discovery'] = timer.timings.get('discovery', 0.0) + output['timings']['discovery']
+        if index_usage:
+            try:
+                add_usage(conn, server_uri, databases, timer, pool)
+            except Exception as e:
+                log.warning('Cannot read index usage of {0}: {1}: {2}'.format(
+                    server_uri, type(e).__name__, e))
+        if timings:
+            timings.observe(label, server_uri, timer.timings)
+        return databases
+
+
+def add_usage(conn, server_uri, databases, timer, pool):
+    # $indexStats of every data bearing member, summed per index
+    namespaces = [
+        '{0}.{1}'.format(db_name, collection['name'])
+        for db_name, output in sorted(databases.items())
+        for collection in output['collections']]
+    aggregator = collect_usage(conn, server_uri, namespaces, timer, pool)
+    for db_name, output in databases.items():
+        for collection in output['collections']:
+            namespace = '{0}.{1}'.format(db_name, collection['name'])
+            collection['usage'] = {}
+            for name in collection['index_names']:
+                used = aggregator.usage(namespace, name)
+                if used:
+                    collection['usage'][name] = used
+
+
+def load_sharding_catalog(conn):
+    # config.databases and config.collections are read once per cluster
+    # instead of once per database and collection. A replica set has
+    # neither, so all of its databases come out unsharded. Shard keys are
+    # decoded as SON, a dict would lose the order of compound keys.
+    catalog = {'databases': {}, 'collections': {}}
+    collections = conn['config'].get_collection(
+        'collections', codec_options=CodecOptions(document_class=SON))
+    for coll_info in collections.find(
+            {'dropped': {'$ne': True}}, {'key': 1}):
+        catalog['collections'][coll_info['_id']] = coll_info.get('key')
+    sharded = set(namespace.split('.', 1)[0] for namespace in catalog['collections'])
+    for db_info in conn['config']['databases'].find({}, {'partitioned': 1}):
+        catalog['databases'][db_info['_id']] = bool(
+            db_info.get('partitioned') or db_info['_id'] in sharded)
+    return catalog
+
+
+def process_database(conn, db_name, catalog, collector, timer, pool):
     log.info('Processing database {0}'.format(db_name))
-    result = conn['config']['databases'].find_one({'_id' : db_name})
     output = {}
-    if result.get('partitioned'):
-        sharded_db = True
-        output['sharded'] = True
-    else:
-        sharded_db = False
-        output['sharded'] = False
+    sharded_db = catalog['databases'].get(db_name, False)
+    output['sharded'] = sharded_db
     output['collections'] = []
-    collections = conn[db_name].collection_names(include_system_collections=False)
-    for coll_name in collections:
-        coll_output = { 'name' :  coll_name }
-        coll_output['indexes'] = []
-        log.debug(coll_output)
+    with pool.slot():
+        namespaces = collector.collect(conn[db_name], timer)
+    for namespace in sorted(namespaces):
+        coll_output = { 'name' :  namespace.split('.', 1)[1] }
         if (sharded_db):
-            coll_info = conn['config']['collections'].find_one({'_id' : db_name+'.'+coll_name})
-            if coll_info and coll_info.get('dropped') == False:
-                coll_output['shard_key'] = coll_info.get('key')
-            else:
-                coll_output['shard_key'] = 'Unsharded'
-        indexes = conn[db_name][coll_name].index_information()
-        for index in indexes.values():
-            log.debug(index)
-            coll_output['indexes'].append(index['key'])
+            coll_output['shard_key'] = catalog['collections'].get(namespace, 'Unsharded')
+        # the [(field, direction), ...] layout of index_information()
+        index_items = sorted(namespaces[namespace].items())
+        coll_output['index_names'] = [name for name, _ in index_items]
+        coll_output['indexes'] = [key.items() for _, key in index_items]
+        coll_output['redundant'] = analyze(
+            dict(index_items), coll_output.get('shard_key'))
+        shard_key = coll_output.get('shard_key')
+        if isinstance(shard_key, dict) and shard_key:
+            coll_output['shard_key_coverage'] = analyze_shard_key(
+                dict(index_items), shard_key)
         log.debug(coll_output)
         output['collections'].append(coll_output)
     return output
@@ -94,13 +242,21 @@ def process_database(conn, db_name):
 def output_excel(final_results, output_file):
     with open(output_file, 'w') as fp:
         csvwriter = csv.writer(fp, delimiter=',', quotechar='"')
-        csvwriter.writerow(['Cluster', 'Database', 'Sharded', 'Collection name', 'Shard key', 'Index key'])
-        for cluster in final_results.keys():
-            for database in cluster.keys():
-                for collection in cluster[database]['collections']:
-                    csvwriter.writerow(cluster, database, 
-                        cluster[database]['sharded'], collection['name'],
-                        collection['shard_key'])
+        csvwriter.writerow(['Cluster', 'Database', 'Sharded', 'Collection name', 'Shard key', 'Index key', 'Index name', 'Usage ops', 'Usage since', 'Shard key index', 'Scatter gather'])
+        for cluster, databases in sorted(final_results.items()):
+            for database, output in sorted(databases.items()):
+                for collection in output['collections']:
+                    usage = collection.get('usage', {})
+                    coverage = collection.get('shard_key_coverage', {})
+                    scatter_gather = coverage.get('scatter_gather', [])
+                    for name, index_key in zip(collection['index_names'], collection['indexes']):
+                        used = usage.get(name, {})
+                        csvwriter.writerow([cluster, database,
+                            output['sharded'], collection['name'],
+                            collection.get('shard_key'), index_key, name,
+                            used.get('ops'), used.get('since'),
+                            coverage.get('status'),
+                            name in scatter_gather or None])
 
 
 if __name__ == '__main__':
@@ -108,5 +264,21 @@ if __name__ == '__main__':
     parser.add_argument('mongo_uri', help='Mongo(d/s) URI')
     parser.add_argument('--output_file',
         help = 'Output file', default='mongo_check')
+    parser.add_argument('--prometheus_file',
+        help = 'Prometheus textfile the per phase probe timings are written to')
+    parser.add_argument('--concurrency',
+        help = 'Maximum number of databases read at the same time',
+        type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--database_concurrency',
+        help = 'Maximum number of databases of one cluster read at the same time',
+        type=int, default=DEFAULT_DATABASE_CONCURRENCY)
+    parser.add_argument('--index_usage',
+        help = 'Add $indexStats usage summed over every data bearing member and write <output_file>_drop_candidates.xls',
+        action='store_true')
+    parser.add_argument('--drop_candidate_ops',
+        help = 'Indexes used at most this many times are drop candidates',
+        type=int, default=0)
     args = parser.parse_args()
-    main(args.mongo_uri, args.output_file)
\ No newline at end of file
+    main(args.mongo_uri, args.output_file, args.prometheus_file,
+        args.concurrency, args.database_concurrency, args.index_usage,
+        args.drop_candidate_ops)
\ No newline at end of file
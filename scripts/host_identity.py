@@ -0,0 +1,90 @@
+import logging
+import socket
+import threading
+
+from mongo_connections import normalize_hosts
+
+log = logging.getLogger('host_identity')
+
+_resolved = {}
+_resolved_lock = threading.Lock()
+
+
+def resolve(host):
+    with _resolved_lock:
+        if host in _resolved:
+            return _resolved[host]
+    try:
+        address = socket.getaddrinfo(host, None)[0][4][0]
+    except socket.error:
+        log.debug('Cannot resolve {0}, using name'.format(host))
+        address = host
+    with _resolved_lock:
+        _resolved[host] = address
+    return address
+
+
+def canonical_host(server_uri, set_name=None):
+    hosts, _, _ = normalize_hosts(server_uri)
+    resolved = []
+    for host in hosts:
+        name, port = host.rsplit(':', 1)
+        resolved.append('{0}:{1}'.format(resolve(name), port))
+    return ','.join(sorted(resolved)), set_name or ''
+
+
+class _Visit(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class VisitedSet(object):
+    # Remembers every node touched during a run. visit() runs the probe the
+    # first time an identity is seen; concurrent and later callers wait for
+    # and share that outcome instead of contacting the node again.
+
+    def __init__(self):
+        self._visits = {}
+        self._lock = threading.Lock()
+
+    def visit(self, identity, probe):
+        with self._lock:
+            visit = self._visits.get(identity)
+            first = visit is None
+            if first:
+                visit = self._visits[identity] = _Visit()
+        if first:
+            try:
+                visit.result = probe()
+            except Exception as e:
+                visit.error = e
+            finally:
+                visit.done.set()
+        else:
+            visit.done.wait()
+        if visit.error is not None:
+            raise visit.error
+        return visit.result, first
+
+    def record(self, identity, result=None, error=None):
+        visit = _Visit()
+        visit.result = result
+        visit.error = error
+        visit.done.set()
+        with self._lock:
+            self._visits.setdefault(identity, visit)
+
+    def add(self, identity):
+        _, first = self.visit(identity, lambda: None)
+        return first
+
+    def __contains__(self, identity):
+        with self._lock:
+            return identity in self._visits
+
+    def __len__(self):
+        with self._lock:
+            return len(self._visits)
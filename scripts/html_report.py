@@ -0,0 +1,113 @@
+import contextlib
+import os
+import re
+
+DEFAULT_BUFFER_BYTES = 1 << 16
+STYLE = """
+        <style type="text/css">
+            .error {
+                background-color: white;
+                color: red;
+            }
+            .warning {
+                background-color: white;
+                color: orange;
+            }
+        </style>\n"""
+UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class BufferedWriter(object):
+    # Collects the many small row writes of a report and hands them to the
+    # file in chunks of about buffer_bytes.
+
+    def __init__(self, out_file, buffer_bytes=DEFAULT_BUFFER_BYTES):
+        self.out_file = out_file
+        self.buffer_bytes = buffer_bytes
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_bytes:
+            self._drain()
+
+    def _drain(self):
+        if self._parts:
+            self.out_file.write(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+
+    def flush(self):
+        self._drain()
+        self.out_file.flush()
+
+    def close(self):
+        self._drain()
+        self.out_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_buffered(path):
+    return BufferedWriter(open(path, 'w'))
+
+
+def write_header(out_file, title):
+    out_file.write('<html>\n')
+    out_file.write('\t<head>\n')
+    out_file.write('\t\t<title>%s</title>\n' % title)
+    out_file.write(STYLE)
+    out_file.write('\t</head>\n')
+    out_file.write('\t<body>\n')
+    out_file.write('\t\t<h1>%s</h1>\n' % title)
+
+
+def write_footer(out_file):
+    out_file.write('\t</body>\n')
+    out_file.write('</html>\n')
+
+
+class PagedReport(object):
+    # <output_file>.html is an index linking to one page per section under
+    # <output_file>_pages/, so no single file has to hold the whole fleet.
+    # Pages are written one at a time and closed before the next one.
+
+    def __init__(self, output_file, title):
+        self.directory = output_file + '_pages'
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.pages = 0
+        self.index = open_buffered(output_file + '.html')
+        write_header(self.index, title)
+
+    @contextlib.contextmanager
+    def page(self, title, summary=''):
+        # Links the page from the index, followed by its summary
+        self.pages += 1
+        name = '{0:05d}_{1}.html'.format(
+            self.pages, UNSAFE_CHARACTERS.sub('_', title))
+        self.index.write('\t\t\t<li><a href="%s/%s">%s</a>%s</li>\n' % (
+            os.path.basename(self.directory),
+            name,
+            title,
+            summary and ' - ' + summary))
+        with open_buffered(os.path.join(self.directory, name)) as out_file:
+            write_header(out_file, title)
+            yield out_file
+            write_footer(out_file)
+
+    def close(self):
+        write_footer(self.index)
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,148 @@
+import threading
+
+from bson.codec_options import CodecOptions
+from bson.son import SON
+from pymongo.errors import OperationFailure
+
+# listCollections and listIndexes arrived with wire version 3 (MongoDB 3.0),
+# nameOnly with wire version 7 (MongoDB 4.0) and $listCatalog with wire
+# version 17 (MongoDB 6.0).
+LIST_INDEXES_WIRE_VERSION = 3
+NAME_ONLY_WIRE_VERSION = 7
+LIST_CATALOG_WIRE_VERSION = 17
+
+
+def index_keys(collection):
+    # {name: key} of one listIndexes
+    return dict(
+        (index['name'], index['key']) for index in collection.list_indexes())
+
+
+class ListIndexesCollector(object):
+    # One nameOnly listCollections per database, then one listIndexes per
+    # collection. A collection holds at most 64 indexes so every listIndexes
+    # fits in its first batch and never needs a getMore.
+    name = 'list_indexes'
+
+    def __init__(self, name_only=True):
+        self.name_only = name_only
+
+    def collect(self, db, timer):
+        options = {'filter': {'type': {'$ne': 'view'}}}
+        if self.name_only:
+            options['nameOnly'] = True
+        with timer.phase('list_collections'):
+            names = sorted(
+                collection['name']
+                for collection in db.list_collections(**options))
+        namespaces = {}
+        with timer.phase('list_indexes'):
+            for name in names:
+                if name.startswith('system.'):
+                    continue
+                index_dict = index_keys(db[name])
+                if index_dict:
+                    namespaces['{0}.{1}'.format(db.name, name)] = index_dict
+        return namespaces
+
+
+class SystemIndexesCollector(object):
+    # Pre 3.0 servers only expose system.indexes. It is read in natural
+    # order with just the fields needed and grouped here, a server side sort
+    # on ns and key scans every index document of the database. Keys are
+    # decoded as SON like listIndexes returns them, so members on either
+    # side of an upgrade fingerprint the same compound index alike.
+    name = 'system_indexes'
+
+    def collect(self, db, timer):
+        namespaces = {}
+        system_indexes = db.get_collection(
+            'system.indexes', codec_options=CodecOptions(document_class=SON))
+        with timer.phase('system_indexes'):
+            for index in system_indexes.find(
+                    {}, SON([('ns', 1), ('name', 1), ('key', 1)])):
+                namespaces.setdefault(
+                    index['ns'], {})[index['name']] = index['key']
+        return namespaces
+
+
+class ListCatalogCollector(object):
+    # One $listCatalog aggregation per member or cluster returns every
+    # collection of every database with its index specs. It runs on the
+    # first collect, the catalog is kept grouped by database for the
+    # others. The stage only runs against admin and needs the
+    # listCollections privilege on the cluster, once refused every database
+    # is read with listIndexes instead. Through mongos each shard reports
+    # its own copy of a collection, their indexes are merged by name.
+    # Time-series collections carry their indexes on the bucket collection
+    # in bucket form, they are read with listIndexes like
+    # ListIndexesCollector does. Views have no indexes.
+    name = 'list_catalog'
+
+    def __init__(self):
+        self.fallback = ListIndexesCollector()
+        self.refused = False
+        self._catalog = None
+        self._lock = threading.Lock()
+
+    def _load(self, client, timer):
+        # {db: ({ns: {name: key}}, set of time-series collection names)}
+        admin = client.get_database(
+            'admin', codec_options=CodecOptions(document_class=SON))
+        pipeline = [
+            {'$listCatalog': {}},
+            {'$match': {'type': {'$in': ['collection', 'timeseries']}}},
+            {'$project': {'db': 1, 'name': 1, 'type': 1, 'md.indexes.spec': 1}}
+        ]
+        catalog = {}
+        with timer.phase('list_catalog'):
+            for entry in admin.aggregate(pipeline):
+                if entry['name'].startswith('system.'):
+                    continue
+                namespaces, timeseries = catalog.setdefault(
+                    entry['db'], ({}, set()))
+                if entry['type'] == 'timeseries':
+                    timeseries.add(entry['name'])
+                    continue
+                index_dict = namespaces.setdefault(
+                    '{0}.{1}'.format(entry['db'], entry['name']), {})
+                for index in entry.get('md', {}).get('indexes', []):
+                    index_dict[index['spec']['name']] = index['spec']['key']
+        return catalog
+
+    def collect(self, db, timer):
+        with self._lock:
+            if self._catalog is None and not self.refused:
+                try:
+                    self._catalog = self._load(db.client, timer)
+                except OperationFailure:
+                    self.refused = True
+        if self.refused:
+            return self.fallback.collect(db, timer)
+        namespaces, timeseries = self._catalog.get(db.name, ({}, ()))
+        namespaces = dict(
+            (ns, index_dict)
+            for ns, index_dict in namespaces.items() if index_dict)
+        if timeseries:
+            with timer.phase('list_indexes'):
+                for name in sorted(timeseries):
+                    index_dict = index_keys(db[name])
+                    if index_dict:
+                        namespaces['{0}.{1}'.format(db.name, name)] = (
+                            index_dict)
+        return namespaces
+
+
+def get_collector(is_master):
+    wire_version = is_master.get('maxWireVersion', 0)
+    if wire_version >= LIST_CATALOG_WIRE_VERSION:
+        return ListCatalogCollector()
+    if wire_version >= LIST_INDEXES_WIRE_VERSION:
+        return ListIndexesCollector(
+            name_only=wire_version >= NAME_ONLY_WIRE_VERSION)
+    return SystemIndexesCollector()
+
+
+def as_namespace_list(namespaces):
+    # The reports keep the historical [{ns: {name: key}}, ...] layout
+    return [{ns: namespaces[ns]} for ns in sorted(namespaces)]
@@ -0,0 +1,75 @@
+import threading
+
+from index_fingerprint import (
+    canonical_key,
+    database_fingerprints,
+    mismatched_namespaces,
+    reference_fingerprints)
+
+
+def canonical_specs(index_dict):
+    return dict(
+        (name, canonical_key(key)) for name, key in index_dict.items())
+
+
+def diff_indexes(server_indexes, reference_indexes):
+    # Keys are compared in canonical form so 1.0 and 1, or the same fields
+    # in a different dict order, are not reported. The original keys are
+    # kept for display.
+    server_specs = canonical_specs(server_indexes)
+    reference_specs = canonical_specs(reference_indexes)
+    server_names = set(server_specs)
+    reference_names = set(reference_specs)
+    return {
+        'missing': [
+            (name, reference_indexes[name])
+            for name in sorted(reference_names - server_names)],
+        'extra': [
+            (name, server_indexes[name])
+            for name in sorted(server_names - reference_names)],
+        'changed': [
+            (name, server_indexes[name], reference_indexes[name])
+            for name in sorted(server_names & reference_names)
+            if server_specs[name] != reference_specs[name]]
+    }
+
+
+def is_empty(diff):
+    return not (diff['missing'] or diff['extra'] or diff['changed'])
+
+
+class IndexDiffer(object):
+    # Diffs members against the reference. Only namespaces present on the
+    # member are compared, and only those whose fingerprint differs from the
+    # reference. A diff depends on nothing but the namespace and the spec
+    # fingerprint, so it is computed once and shared by every member with
+    # the same specs.
+
+    def __init__(self, reference, specs):
+        self.reference = reference
+        self.specs = specs
+        self.reference_namespaces = reference_fingerprints(reference)
+        self.reference_databases = database_fingerprints(
+            self.reference_namespaces)
+        self._diffs = {}
+        self._lock = threading.Lock()
+
+    def diff_namespace(self, namespace, fingerprint):
+        with self._lock:
+            diff = self._diffs.get((namespace, fingerprint))
+        if diff is None:
+            reference = self.reference.get(namespace, {})
+            diff = diff_indexes(
+                self.specs.get(fingerprint), reference.get('indexes', {}))
+            with self._lock:
+                self._diffs[(namespace, fingerprint)] = diff
+        return diff
+
+    def diff_member(self, member):
+        diffs = []
+        for namespace, fingerprint in mismatched_namespaces(
+                member, self.reference_namespaces, self.reference_databases):
+            diff = self.diff_namespace(namespace, fingerprint)
+            if not is_empty(diff):
+                diffs.append((namespace, diff))
+        return diffs
@@ -0,0 +1,126 @@
+import collections
+import hashlib
+import json
+import threading
+
+from bson.son import SON
+
+
+def canonical_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, dict):
+        return canonical_key(value)
+    if isinstance(value, list):
+        return tuple(canonical_value(item) for item in value)
+    return value
+
+
+def canonical_key(key):
+    # Field order matters for compound indexes. It is kept when the driver
+    # handed us an ordered mapping, plain dicts have lost it already and are
+    # sorted so the same fields always give the same tuple.
+    items = key.items()
+    if not isinstance(key, (SON, collections.OrderedDict)):
+        items = sorted(items)
+    return tuple((field, canonical_value(value)) for field, value in items)
+
+
+def canonical_indexes(index_dict):
+    return tuple(sorted(
+        (name, canonical_key(key)) for name, key in index_dict.items()))
+
+
+def digest(canonical):
+    return hashlib.sha1(
+        json.dumps(canonical, separators=(',', ':'))).hexdigest()
+
+
+def database_name(namespace):
+    return namespace.split('.', 1)[0]
+
+
+def database_fingerprints(namespace_fingerprints):
+    databases = {}
+    for namespace in sorted(namespace_fingerprints):
+        databases.setdefault(database_name(namespace), []).append(
+            (namespace, namespace_fingerprints[namespace]))
+    return dict(
+        (database, digest(fingerprints))
+        for database, fingerprints in databases.items())
+
+
+def reference_fingerprints(reference):
+    return dict(
+        (namespace, digest(canonical_indexes(body['indexes'])))
+        for namespace, body in reference.items())
+
+
+class SpecStore(object):
+    # Content addressed index specs. Every distinct {name: key} set of a
+    # namespace is kept once however many members share it, members only
+    # carry the fingerprints.
+
+    def __init__(self):
+        self._specs = {}
+        self._lock = threading.Lock()
+
+    def add(self, index_dict):
+        fingerprint = digest(canonical_indexes(index_dict))
+        with self._lock:
+            first = fingerprint not in self._specs
+            if first:
+                self._specs[fingerprint] = index_dict
+        return fingerprint, first
+
+    def put(self, fingerprint, index_dict):
+        with self._lock:
+            self._specs.setdefault(fingerprint, index_dict)
+
+    def get(self, fingerprint):
+        with self._lock:
+            return self._specs[fingerprint]
+
+    def items(self):
+        with self._lock:
+            return self._specs.items()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._specs)
+
+    def fingerprint_member(self, collection_indexes, on_new=None):
+        # [{ns: {name: key}}, ...] to the fingerprints a member is compared
+        # and stored by. on_new sees every spec the store did not hold yet.
+        namespaces = {}
+        for collection in collection_indexes:
+            for namespace, index_dict in collection.items():
+                fingerprint, first = self.add(index_dict)
+                if first and on_new:
+                    on_new(fingerprint, index_dict)
+                namespaces[namespace] = fingerprint
+        return {
+            'namespaces': namespaces,
+            'databases': database_fingerprints(namespaces)
+        }
+
+    def expand_member(self, member):
+        return [
+            {namespace: self.get(member['namespaces'][namespace])}
+            for namespace in sorted(member['namespaces'])]
+
+
+def mismatched_namespaces(member, reference_namespaces, reference_databases):
+    # Whole databases whose fingerprint matches the reference are skipped,
+    # then namespaces whose fingerprint matches. Only what is left needs
+    # its specs compared.
+    mismatched = set(
+        database for database, fingerprint in member['databases'].items()
+        if reference_databases.get(database) != fingerprint)
+    if not mismatched:
+        return []
+    return sorted(
+        (namespace, fingerprint)
+        for namespace, fingerprint in member['namespaces'].items()
+        if database_name(namespace) in mismatched and
+        reference_namespaces.get(namespace) != fingerprint)
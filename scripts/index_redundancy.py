@@ -0,0 +1,190 @@
+import argparse
+import collections
+import csv
+import logging
+import time
+
+from bson.son import SON
+
+log = logging.getLogger('index_redundancy')
+
+DUPLICATE = 'duplicate'
+PREFIX = 'prefix'
+SHARD_KEY = 'shard_key'
+# Never reported, whatever covers them
+PROTECTED_INDEXES = ('_id_',)
+ORDERED_TYPES = (SON, collections.OrderedDict)
+NUMBERS = (int, long, float)
+HASHED = 'hashed'
+WILDCARD = '$**'
+
+
+def key_pairs(index_key):
+    # (field, direction) pairs of a key given as a mapping or as the
+    # [(field, direction), ...] list of index_information(), integral float
+    # directions as ints. None for a compound key decoded into a plain dict:
+    # its field order is lost and any order picked here could report an
+    # index as covered when it is not.
+    pairs = index_key
+    if isinstance(index_key, dict):
+        if len(index_key) > 1 and not isinstance(index_key, ORDERED_TYPES):
+            return None
+        pairs = index_key.items()
+    return tuple(
+        (field, int(direction)
+         if type(direction) is float and direction.is_integer()
+         else direction)
+        for field, direction in pairs)
+
+
+def key_fields(index_key):
+    # key_pairs() of the key, an index can be walked backwards so a key
+    # starting with a descending field is stored reversed: {a: -1, b: 1}
+    # covers the same queries as {a: 1, b: -1}
+    fields = key_pairs(index_key)
+    if fields and type(fields[0][1]) in NUMBERS and fields[0][1] < 0:
+        fields = tuple(
+            (field, -direction if type(direction) in NUMBERS else direction)
+            for field, direction in fields)
+    return fields
+
+
+def is_plain(fields):
+    # Ascending, descending and hashed fields only. Text, 2d, 2dsphere,
+    # geoHaystack and wildcard indexes do not serve plain queries on their
+    # other fields and leave out documents a plain index holds.
+    return all(
+        (type(direction) in NUMBERS or direction == HASHED) and
+        not field.endswith(WILDCARD)
+        for field, direction in fields)
+
+
+def build_trie(indexes):
+    # A node is a pair of its children by (field, direction) and the names
+    # of the indexes whose key ends there. Keys of unknown field order and
+    # special indexes are left out, they are neither reported nor covering.
+    root = ({}, [])
+    for name in sorted(indexes):
+        fields = key_fields(indexes[name])
+        if fields is None:
+            log.debug('Skipping {0}, field order of {1} unknown'.format(
+                name, indexes[name]))
+            continue
+        if not is_plain(fields):
+            continue
+        node = root
+        for edge in fields:
+            node = node[0].setdefault(edge, ({}, []))
+        node[1].append(name)
+    return root
+
+
+def analyze(indexes, shard_key=None):
+    # Redundant indexes of one namespace, indexes is {name: key}. Only key
+    # patterns are compared: unique, sparse, partial or collation options
+    # the catalog does not record can still make a reported index needed.
+    root = build_trie(indexes)
+    shard_prefixes = set()
+    shard_names = []
+    shard_fields = None
+    if isinstance(shard_key, dict) and shard_key:
+        shard_fields = key_fields(shard_key)
+    if shard_fields:
+        node = root
+        for edge in shard_fields:
+            node = node[0].get(edge)
+            if node is None:
+                break
+            shard_prefixes.add(id(node))
+        else:
+            shard_prefixes.discard(id(node))
+            shard_names = node[1]
+        if not shard_names:
+            # no index on the shard key to be covered by
+            shard_prefixes = set()
+    findings = []
+
+    def walk(node):
+        # Returns the name of an index ending at or below node
+        below = None
+        for edge in sorted(node[0]):
+            found = walk(node[0][edge])
+            below = below or found
+        names = node[1]
+        if not names:
+            return below
+        keep = names[0]
+        for name in PROTECTED_INDEXES:
+            if name in names:
+                keep = name
+        for name in names:
+            if name != keep and name not in PROTECTED_INDEXES:
+                findings.append((name, DUPLICATE, keep))
+        if keep in PROTECTED_INDEXES or names is shard_names:
+            return keep
+        if id(node) in shard_prefixes:
+            findings.append((keep, SHARD_KEY, shard_names[0]))
+        elif below:
+            findings.append((keep, PREFIX, below))
+        return keep
+
+    walk(root)
+    return [
+        {'index': name, 'kind': kind, 'covered_by': covered_by}
+        for name, kind, covered_by in sorted(findings)]
+
+
+def redundant_indexes(final_results):
+    # Rows of every redundant index in a get_mongo_collection_indexes
+    # catalog, whose collections carry their findings under 'redundant'
+    for cluster, databases in sorted(final_results.items()):
+        for database, output in sorted(databases.items()):
+            for collection in output['collections']:
+                keys = dict(zip(
+                    collection['index_names'], collection['indexes']))
+                for finding in collection.get('redundant', []):
+                    yield (
+                        cluster,
+                        '{0}.{1}'.format(database, collection['name']),
+                        finding['index'],
+                        keys.get(finding['index']),
+                        finding['kind'],
+                        finding['covered_by'],
+                        keys.get(finding['covered_by']))
+
+
+def write_redundant(output_file, rows):
+    with open(output_file, 'w') as fp:
+        csvwriter = csv.writer(fp, delimiter=',', quotechar='"')
+        csvwriter.writerow([
+            'Cluster', 'Namespace', 'Index name', 'Index key', 'Kind',
+            'Covered by', 'Covering key'])
+        for row in rows:
+            csvwriter.writerow(row)
+
+
+def measure(namespaces, indexes_per_namespace):
+    # analyze() over namespaces collections with a prefix covered index and
+    # a duplicate each
+    indexes = {'_id_': {'_id': 1}}
+    for index in xrange(1, indexes_per_namespace):
+        fields = ['f{0}'.format(field) for field in xrange(1, index + 1)]
+        indexes['_'.join(fields)] = [(field, 1) for field in fields]
+    indexes['copy'] = [('f1', -1)]
+    start = time.time()
+    findings = sum(
+        len(analyze(indexes, {'f1': 1})) for _ in xrange(namespaces))
+    return findings, time.time() - start
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level='INFO',
+        format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--namespaces', type=int, default=100000)
+    parser.add_argument('--indexes_per_namespace', type=int, default=8)
+    args = parser.parse_args()
+    findings, seconds = measure(args.namespaces, args.indexes_per_namespace)
+    log.info('{0} findings over {1} namespaces in {2:.2f}s'.format(
+        findings, args.namespaces, seconds))
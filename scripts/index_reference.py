@@ -0,0 +1,88 @@
+import collections
+import threading
+
+from index_fingerprint import canonical_indexes, canonical_key, digest
+
+REFERENCE_MODES = ('majority', 'union', 'primary')
+DEFAULT_REFERENCE_MODE = 'majority'
+
+
+class ReferenceBuilder(object):
+    # Counts how many members hold each spec fingerprint of a namespace.
+    # Members sharing the same indexes cost one counter, the specs are only
+    # expanded into (name, key) votes when the reference is built, which can
+    # be done at any time while members are still coming in.
+    #
+    # majority: an index is in the reference when more than half of the
+    #           members holding the namespace have it with the same key
+    # union:    every index seen on any member
+    # primary:  the indexes of the primaries holding the namespace, majority
+    #           for namespaces no primary reported
+
+    def __init__(self, specs, mode=DEFAULT_REFERENCE_MODE):
+        if mode not in REFERENCE_MODES:
+            raise ValueError('Unknown reference mode {0}'.format(mode))
+        self.specs = specs
+        self.mode = mode
+        self._counts = {}
+        self._primaries = {}
+        self._lock = threading.Lock()
+
+    def add(self, namespaces, primary=False):
+        # namespaces is the {ns: fingerprint} of one member
+        with self._lock:
+            for namespace, fingerprint in namespaces.items():
+                counts = self._counts.setdefault(namespace, {})
+                counts[fingerprint] = counts.get(fingerprint, 0) + 1
+                if primary:
+                    self._primaries.setdefault(namespace, set()).add(
+                        fingerprint)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._counts)
+
+    def reference(self):
+        with self._lock:
+            namespaces = [
+                (namespace, dict(counts),
+                 set(self._primaries.get(namespace, ())))
+                for namespace, counts in self._counts.items()]
+        reference = {}
+        for namespace, counts, primaries in namespaces:
+            reference[namespace] = self._build(counts, primaries)
+        return reference
+
+    def _build(self, counts, primaries):
+        holders = sum(counts.values())
+        votes = collections.Counter()
+        keys = {}
+        for fingerprint, count in counts.items():
+            for name, key in self.specs.get(fingerprint).items():
+                vote = (name, canonical_key(key))
+                votes[vote] += count
+                keys.setdefault(vote, key)
+        if self.mode == 'union':
+            chosen = set(votes)
+        elif self.mode == 'primary' and primaries:
+            chosen = set(
+                (name, canonical_key(key))
+                for fingerprint in primaries
+                for name, key in self.specs.get(fingerprint).items())
+        else:
+            chosen = set(
+                vote for vote, count in votes.items() if count * 2 > holders)
+        # Two keys under one index name (e.g. two primaries disagreeing)
+        # resolve to the more common one.
+        indexes = {}
+        for vote in sorted(chosen, key=lambda vote: -votes[vote]):
+            name = vote[0]
+            if name not in indexes:
+                indexes[name] = keys[vote]
+        agreeing = counts.get(digest(canonical_indexes(indexes)), 0)
+        return {
+            'index_count': len(indexes),
+            'indexes': indexes,
+            'members': holders,
+            'agreement': round(float(agreeing) / holders, 3)
+        }
@@ -0,0 +1,112 @@
+import datetime
+import json
+import os
+
+from bson.son import SON
+
+from index_diff import diff_indexes
+from index_fingerprint import database_name
+from index_store import IndexStore
+from result_stream import coroutine
+
+
+@coroutine
+def snapshot_writer(path, cluster, specs):
+    # Members are written as they are sent, the specs they refer to once
+    # when closed. Written next to the target and renamed so an interrupted
+    # run never leaves half a snapshot behind.
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as out_file:
+        out_file.write('{"cluster":%s,"created":%s,"members":{' % (
+            json.dumps(cluster),
+            json.dumps(datetime.datetime.utcnow().isoformat())))
+        index = 0
+        try:
+            while True:
+                server, member = yield
+                out_file.write(',' if index else '')
+                out_file.write('%s:%s' % (
+                    json.dumps(server),
+                    json.dumps(member, separators=(',', ':'))))
+                index += 1
+        except GeneratorExit:
+            out_file.write('},"specs":')
+            json.dump(dict(specs.items()), out_file, separators=(',', ':'))
+            out_file.write('}')
+    os.rename(temp_path, path)
+
+
+def load_snapshot(path):
+    # The members and specs are moved into an IndexStore, the decoded
+    # document is dropped. Objects are decoded as SON so compound keys
+    # compare equal to the ones of the current run.
+    with open(path) as fp:
+        snapshot = json.load(fp, object_pairs_hook=SON)
+    store = IndexStore()
+    for fingerprint, index_dict in snapshot.pop('specs').items():
+        store.put(fingerprint, index_dict)
+    for server, member in snapshot.pop('members').items():
+        store.add_member(server, member)
+    snapshot['store'] = store
+    return snapshot
+
+
+def changed_namespaces(member, previous):
+    # Databases with the same fingerprint in both are skipped whole
+    databases = set(member['databases']) | set(previous['databases'])
+    changed = set(
+        database for database in databases
+        if member['databases'].get(database) !=
+        previous['databases'].get(database))
+    if not changed:
+        return []
+    namespaces = set(member['namespaces']) | set(previous['namespaces'])
+    return sorted(
+        (namespace,
+         member['namespaces'].get(namespace),
+         previous['namespaces'].get(namespace))
+        for namespace in namespaces
+        if database_name(namespace) in changed and
+        member['namespaces'].get(namespace) !=
+        previous['namespaces'].get(namespace))
+
+
+def new_changes():
+    return {'added': [], 'removed': [], 'indexes': []}
+
+
+@coroutine
+def changes_collector(previous, specs, changes):
+    # Index changes of every member sent since the previous snapshot, added
+    # to changes. A member or namespace unchanged since then costs one
+    # fingerprint comparison and a diff is computed once per pair of spec
+    # fingerprints.
+    previous_store = previous['store']
+    diffs = {}
+    seen = set()
+    try:
+        while True:
+            server, member = yield
+            seen.add(server)
+            if server not in previous_store:
+                changes['added'].append(server)
+                continue
+            for namespace, fingerprint, previous_fingerprint in (
+                    changed_namespaces(
+                        member, previous_store.member(server))):
+                pair = (fingerprint, previous_fingerprint)
+                if pair not in diffs:
+                    diffs[pair] = diff_indexes(
+                        specs.get(fingerprint) if fingerprint else {},
+                        previous_store.get(previous_fingerprint)
+                        if previous_fingerprint else {})
+                diff = diffs[pair]
+                changes['indexes'].append({
+                    'server': server,
+                    'namespace': namespace,
+                    'added': diff['extra'],
+                    'removed': diff['missing'],
+                    'changed': diff['changed']
+                })
+    except GeneratorExit:
+        changes['removed'] = sorted(set(previous_store.servers()) - seen)
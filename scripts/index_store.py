@@ -0,0 +1,196 @@
+import argparse
+import array
+import json
+import logging
+import sys
+import threading
+
+from index_fingerprint import (
+    SpecStore,
+    canonical_indexes,
+    canonical_key,
+    database_fingerprints,
+    digest)
+
+log = logging.getLogger('index_store')
+
+
+class _Table(object):
+    # Interns values to small integer ids
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def intern(self, value, stored=None):
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value if stored is None else stored)
+        return value_id
+
+
+class IndexStore(SpecStore):
+    # Compact SpecStore that also holds members. Namespaces, index names
+    # and keys are interned once, a spec is an array of (name id, key id)
+    # pairs and a member two parallel arrays of namespace and spec ids plus
+    # two of database and database fingerprint ids. Specs and members are
+    # rebuilt as plain dicts on access.
+
+    def __init__(self):
+        self._namespaces = _Table()
+        self._names = _Table()
+        self._keys = _Table()
+        self._fingerprints = _Table()
+        self._databases = _Table()
+        self._database_fingerprints = _Table()
+        self._specs = []
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def _put(self, fingerprint, index_dict):
+        spec_id = self._fingerprints.intern(fingerprint)
+        if spec_id == len(self._specs):
+            entries = array.array('i')
+            for name, key in sorted(index_dict.items()):
+                entries.append(self._names.intern(name))
+                entries.append(self._keys.intern(canonical_key(key), key))
+            self._specs.append(entries)
+        return spec_id
+
+    def add(self, index_dict):
+        fingerprint = digest(canonical_indexes(index_dict))
+        with self._lock:
+            first = fingerprint not in self._fingerprints.ids
+            self._put(fingerprint, index_dict)
+        return fingerprint, first
+
+    def put(self, fingerprint, index_dict):
+        with self._lock:
+            self._put(fingerprint, index_dict)
+
+    def _spec(self, spec_id):
+        entries = self._specs[spec_id]
+        return dict(
+            (self._names.values[entries[i]],
+             self._keys.values[entries[i + 1]])
+            for i in xrange(0, len(entries), 2))
+
+    def get(self, fingerprint):
+        with self._lock:
+            return self._spec(self._fingerprints.ids[fingerprint])
+
+    def items(self):
+        with self._lock:
+            return [
+                (fingerprint, self._spec(spec_id))
+                for fingerprint, spec_id in self._fingerprints.ids.items()]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._specs)
+
+    def add_member(self, server, member):
+        # member is {'namespaces': {ns: fingerprint}, 'databases': {db:
+        # fingerprint}}, every namespace fingerprint must already be in the
+        # store. The databases are computed when missing.
+        databases = member.get('databases')
+        if databases is None:
+            databases = database_fingerprints(member['namespaces'])
+        namespace_ids = array.array('i')
+        spec_ids = array.array('i')
+        database_ids = array.array('i')
+        database_fingerprint_ids = array.array('i')
+        with self._lock:
+            for namespace, fingerprint in sorted(
+                    member['namespaces'].items()):
+                namespace_ids.append(self._namespaces.intern(namespace))
+                spec_ids.append(self._fingerprints.ids[fingerprint])
+            for database, fingerprint in sorted(databases.items()):
+                database_ids.append(self._databases.intern(database))
+                database_fingerprint_ids.append(
+                    self._database_fingerprints.intern(fingerprint))
+            self._members[server] = (
+                namespace_ids,
+                spec_ids,
+                database_ids,
+                database_fingerprint_ids)
+
+    def member(self, server):
+        with self._lock:
+            namespace_ids, spec_ids, database_ids, database_fingerprint_ids = (
+                self._members[server])
+            namespaces = dict(
+                (self._namespaces.values[namespace_id],
+                 self._fingerprints.values[spec_id])
+                for namespace_id, spec_id in zip(namespace_ids, spec_ids))
+            databases = dict(
+                (self._databases.values[database_id],
+                 self._database_fingerprints.values[fingerprint_id])
+                for database_id, fingerprint_id in zip(
+                    database_ids, database_fingerprint_ids))
+        return {
+            'namespaces': namespaces,
+            'databases': databases
+        }
+
+    def servers(self):
+        with self._lock:
+            return sorted(self._members)
+
+    def members(self):
+        for server in self.servers():
+            yield server, self.member(server)
+
+    def __contains__(self, server):
+        with self._lock:
+            return server in self._members
+
+
+def deep_size(value, seen=None):
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(
+            deep_size(key, seen) + deep_size(item, seen)
+            for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(deep_size(item, seen) for item in value)
+    elif isinstance(value, (IndexStore, _Table)):
+        size += deep_size(value.__dict__, seen)
+    return size
+
+
+def measure(scale):
+    # RESULTS scaled to <scale> copies of every member, each decoded on its
+    # own the way members arrive from the servers or the stream.
+    from sample_index_results import RESULTS
+    servers = {}
+    for copy in xrange(scale):
+        for server, namespaces in RESULTS['servers'].items():
+            servers['{0}-{1}'.format(server, copy)] = json.loads(
+                json.dumps(namespaces))
+    store = IndexStore()
+    for server, namespaces in servers.items():
+        store.add_member(server, store.fingerprint_member(namespaces))
+    return deep_size(servers), deep_size(store)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level='INFO',
+        format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--scale',
+        help='Copies of every sample member',
+        type=int,
+        default=1000)
+    args = parser.parse_args()
+    results_size, store_size = measure(args.scale)
+    log.info('results[servers] {0} bytes, IndexStore {1} bytes, {2:.1f}x '
+             'smaller'.format(
+                 results_size, store_size, float(results_size) / store_size))
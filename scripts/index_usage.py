@@ -0,0 +1,173 @@
+import csv
+import logging
+import threading
+
+from pymongo.errors import OperationFailure
+
+from mongo_connections import lease_client
+from mongo_setup import CONNECTION_TIMEOUT_MS
+from probe_pool import ProbePool
+from topology_cache import get_replica_set_topology, get_sharded_topology
+
+log = logging.getLogger('index_usage')
+
+# Indexes that cannot be dropped whatever their usage
+PROTECTED_INDEXES = ('_id_',)
+
+
+class UsageAggregator(object):
+    # Folds the $indexStats of every member into one counter per
+    # (namespace, index name) as they arrive: the summed accesses.ops, the
+    # latest accesses.since and the number of members that reported.
+    # Memory grows with the number of indexes, not members.
+
+    def __init__(self):
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def add(self, namespace, stats):
+        ops = stats['accesses']['ops']
+        since = stats['accesses']['since']
+        key = (namespace, stats['name'])
+        with self._lock:
+            entry = self._usage.get(key)
+            if entry is None:
+                self._usage[key] = [ops, since, 1]
+            else:
+                entry[0] += ops
+                # counting started on every member before the latest since
+                entry[1] = max(entry[1], since)
+                entry[2] += 1
+
+    def usage(self, namespace, name):
+        with self._lock:
+            entry = self._usage.get((namespace, name))
+        if entry is None:
+            return None
+        return {
+            'ops': entry[0],
+            'since': entry[1].isoformat(),
+            'members': entry[2]
+        }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._usage)
+
+
+def replica_set_members(node):
+    # Data bearing members only, arbiters have no indexes
+    with lease_client(
+            node,
+            connectTimeoutMS=CONNECTION_TIMEOUT_MS,
+            slaveOk=True) as conn:
+        rsconfig = conn['local']['system.replset'].find_one()
+    if rsconfig:
+        return [
+            member['host'] for member in rsconfig['members']
+            if not member.get('arbiterOnly')]
+    return [node]
+
+
+def data_members(conn, seed, pool):
+    # Takes its own slots around each read, the sharded discovery takes
+    # them per shard
+    with pool.slot():
+        is_mongos = conn.is_mongos
+    if is_mongos:
+        topology = get_sharded_topology(
+            conn, seed, replica_set_members, pool=pool, include_configs=False)
+        members = []
+        for shard in topology['shards']:
+            if shard['members'] is None:
+                log.warning('Cannot read index usage of shard {0}'.format(
+                    shard['_id']))
+                continue
+            members.extend(shard['members'])
+        return members
+    with pool.slot():
+        return get_replica_set_topology(conn, seed, replica_set_members)
+
+
+def collect_member_usage(conn, namespaces, aggregator, timer):
+    # One $indexStats per collection, a collection the member does not hold
+    # reports nothing
+    for namespace in namespaces:
+        db_name, coll_name = namespace.split('.', 1)
+        try:
+            with timer.phase('index_stats'):
+                for stats in conn[db_name][coll_name].aggregate(
+                        [{'$indexStats': {}}]):
+                    aggregator.add(namespace, stats)
+        except OperationFailure as e:
+            log.debug('No index usage for {0}: {1}'.format(namespace, e))
+
+
+def collect_usage(conn, seed, namespaces, timer, pool=None):
+    # Index usage of namespaces summed over every data bearing member of the
+    # cluster conn is connected to, usage is counted per member so
+    # secondaries serving reads are included.
+    pool = pool or ProbePool(1)
+    aggregator = UsageAggregator()
+    members = data_members(conn, seed, pool)
+
+    def collect(member):
+        try:
+            with pool.slot():
+                with lease_client(
+                        member,
+                        connectTimeoutMS=CONNECTION_TIMEOUT_MS,
+                        slaveOk=True) as member_conn:
+                    collect_member_usage(
+                        member_conn, namespaces, aggregator, timer)
+        except Exception as e:
+            log.warning('Cannot read index usage of {0}: {1}: {2}'.format(
+                member, type(e).__name__, e))
+
+    pool.map(collect, members)
+    log.info('Index usage of {0} indexes from {1} members of {2}'.format(
+        len(aggregator), len(members), seed))
+    return aggregator
+
+
+def is_shard_key(index_key, shard_key):
+    return isinstance(shard_key, dict) and dict(index_key) == dict(shard_key)
+
+
+def drop_candidates(final_results, max_ops=0):
+    # Indexes used at most max_ops times, the least used first and among
+    # those the ones observed the longest
+    candidates = []
+    for cluster, databases in final_results.items():
+        for database, output in databases.items():
+            for collection in output['collections']:
+                usage = collection.get('usage', {})
+                for name, index_key in zip(
+                        collection['index_names'], collection['indexes']):
+                    used = usage.get(name)
+                    if (used is None or used['ops'] > max_ops or
+                            name in PROTECTED_INDEXES or
+                            is_shard_key(index_key, collection.get('shard_key'))):
+                        continue
+                    candidates.append((
+                        used['ops'],
+                        used['since'],
+                        cluster,
+                        '{0}.{1}'.format(database, collection['name']),
+                        name,
+                        index_key,
+                        used['members']))
+    candidates.sort(key=lambda candidate: candidate[:5])
+    return candidates
+
+
+def write_drop_candidates(output_file, candidates):
+    with open(output_file, 'w') as fp:
+        csvwriter = csv.writer(fp, delimiter=',', quotechar='"')
+        csvwriter.writerow([
+            'Cluster', 'Namespace', 'Index name', 'Index key', 'Ops', 'Since',
+            'Members'])
+        for ops, since, cluster, namespace, name, index_key, members in (
+                candidates):
+            csvwriter.writerow([
+                cluster, namespace, name, index_key, ops, since, members])
@@ -0,0 +1,117 @@
+import atexit
+import collections
+import contextlib
+import logging
+import threading
+
+from pymongo import MongoClient, uri_parser
+
+DEFAULT_MAX_CLIENTS = 64
+DEFAULT_PORT = 27017
+
+log = logging.getLogger('mongo_connections')
+
+
+def normalize_hosts(uri):
+    if '://' not in uri:
+        uri = 'mongodb://' + uri
+    parsed = uri_parser.parse_uri(uri, DEFAULT_PORT, warn=True)
+    hosts = sorted(
+        '{0}:{1}'.format(host.lower(), port)
+        for host, port in parsed['nodelist'])
+    options = sorted(
+        (name.lower(), repr(value))
+        for name, value in parsed['options'].items())
+    return tuple(hosts), parsed['username'], tuple(options)
+
+
+def client_key(uri, options):
+    hosts, username, uri_options = normalize_hosts(uri)
+    kwargs = tuple(sorted(
+        (name.lower(), repr(value)) for name, value in options.items()))
+    return hosts, username, uri_options, kwargs
+
+
+class ConnectionRegistry(object):
+    # Hands out one MongoClient per normalized host list and options as a
+    # lease, keeps at most max_clients of them open and closes the least
+    # recently used idle one beyond that. A leased client is never closed,
+    # while more than max_clients are leased they all stay open.
+
+    def __init__(self, max_clients=DEFAULT_MAX_CLIENTS, factory=MongoClient):
+        self.max_clients = max_clients
+        self.factory = factory
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clients = collections.OrderedDict()
+        self._leases = collections.Counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def lease(self, uri, **options):
+        key = client_key(uri, options)
+        with self._lock:
+            client = self._clients.pop(key, None)
+            if client is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                log.debug('Opening client for {0}'.format(uri))
+                client = self.factory(uri, **options)
+            self._clients[key] = client
+            self._leases[key] += 1
+        try:
+            yield client
+        finally:
+            with self._lock:
+                self._leases[key] -= 1
+                if self._leases[key] <= 0:
+                    del self._leases[key]
+                evicted = self._evict()
+            for lru_client in evicted:
+                lru_client.close()
+
+    def _evict(self):
+        # the least recently used idle clients beyond max_clients, called
+        # with the lock held
+        evicted = []
+        excess = len(self._clients) - self.max_clients
+        for key in list(self._clients):
+            if excess <= 0:
+                break
+            if key not in self._leases:
+                evicted.append(self._clients.pop(key))
+                self.evictions += 1
+                excess -= 1
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'open': len(self._clients),
+                'leased': len(self._leases)
+            }
+
+    def close_all(self):
+        log.debug('Closing clients, stats {0}'.format(self.stats()))
+        with self._lock:
+            clients = self._clients.values()
+            self._clients.clear()
+            self._leases.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                log.exception('Error closing client {0}'.format(client))
+
+
+registry = ConnectionRegistry()
+atexit.register(registry.close_all)
+
+
+def lease_client(uri, **options):
+    return registry.lease(uri, **options)
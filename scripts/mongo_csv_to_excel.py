@@ -9,21 +9,30 @@ def main(input_file):
 		catalog = json.load(fp)
 		with open(output_file, 'w') as fp:
 			csvwriter = csv.writer(fp, delimiter=',', quotechar='"')
-			csvwriter.writerow(['Cluster', 'Database', 'Sharded', 'Collection name', 'Shard key', 'Index key'])
+			csvwriter.writerow(['Cluster', 'Database', 'Sharded', 'Collection name', 'Shard key', 'Index key', 'Index name', 'Usage ops', 'Usage since', 'Shard key index', 'Scatter gather'])
 			for cluster in catalog.keys():
 				for database in catalog[cluster]:
 					for collection in catalog[cluster][database]['collections']:
 						indexes = collection.get('indexes', {})
 						if len(indexes) > 0:
-							for index in indexes:
+							names = collection.get('index_names', [None] * len(indexes))
+							usage = collection.get('usage', {})
+							coverage = collection.get('shard_key_coverage', {})
+							scatter_gather = coverage.get('scatter_gather', [])
+							for name, index in zip(names, indexes):
+								used = usage.get(name, {})
 								csvwriter.writerow([cluster, database,
 									catalog[cluster][database]['sharded'], collection['name'],
-									collection.get('shard_key'), index])
+									collection.get('shard_key'), index, name,
+									used.get('ops'), used.get('since'),
+									coverage.get('status'),
+									name in scatter_gather or None])
 
 						else:
 							csvwriter.writerow([cluster, database,
 								catalog[cluster][database]['sharded'], collection['name'],
-								collection.get('shard_key')])
+								collection.get('shard_key'), None, None, None, None,
+								collection.get('shard_key_coverage', {}).get('status')])
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -2,17 +2,24 @@
 
 import argparse
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import OperationFailure
 
 MONITORING_DB = 'mongo_monitoring'
 MONITORING_HOSTS = 'monitoring_hosts'
 CONNECTION_TIMEOUT_MS = 5000
+TOPOLOGY_CACHE = 'topology_cache'
+TOPOLOGY_CACHE_TTL_SECONDS = 3600
+# The TTL index only clears out old entries, how long one is reused is
+# --topology_ttl, which may not exceed this
+TOPOLOGY_CACHE_MAX_TTL_SECONDS = 7 * 24 * 3600
 
 
 def install_monitoring_mongo(mongo_uri):
     conn = MongoClient(mongo_uri, connectTimeoutMS=CONNECTION_TIMEOUT_MS)
     db = conn[MONITORING_DB]
     setup_hosts(db)
+    setup_topology_cache(db)
 
 def setup_hosts(db):
     # lists of hosts to monitor in the form of
@@ -24,8 +31,12 @@ def setup_hosts(db):
     #     'live' : True/False     <-- is this a cluster to be monitored
     #     'process_mongos' : True/False <-- if connected to a sharded cluster
     #         get the status of each mongos
+    #     'interval_seconds' : 3600  <-- optional, how often --daemon checks
+    #         the cluster. config_interval_seconds / index_interval_seconds
+    #         override it for check_mongo_config / check_mongo_indexes
     # }
     hosts_collection = db[MONITORING_HOSTS]
+    hosts_collection.create_index([('live', ASCENDING), ('_id', ASCENDING)])
     hosts_collection.save( {
         '_id' : 'my_localhost_1',
         'hosts' : ['localhost:27018'],
@@ -38,6 +49,30 @@ def setup_hosts(db):
         'process_mongos' : True}
     )
 
+def live_hosts(db):
+    return db[MONITORING_HOSTS].find({'live': True}).sort('_id', ASCENDING)
+
+def setup_topology_cache(db):
+    # discovered topologies, see topology_cache.py
+    # {
+    #     '_id' : 'normalized seed host list',
+    #     'fingerprint' : 'hash of config.shards / replica set config version',
+    #     'topology' : {'configs': [], 'mongos': [], 'shards': []},
+    #     'updated' : datetime   <-- documents expire through a TTL index
+    # }
+    try:
+        db[TOPOLOGY_CACHE].create_index(
+            [('updated', ASCENDING)],
+            expireAfterSeconds=TOPOLOGY_CACHE_MAX_TTL_SECONDS)
+    except OperationFailure:
+        # installed with another expiry, e.g. the former one hour
+        db.command(
+            'collMod',
+            TOPOLOGY_CACHE,
+            index={
+                'keyPattern': {'updated': ASCENDING},
+                'expireAfterSeconds': TOPOLOGY_CACHE_MAX_TTL_SECONDS})
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('mongo_uri', help='Mongod URI')
@@ -0,0 +1,61 @@
+import contextlib
+import copy
+import threading
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_CLUSTER_CONCURRENCY = 8
+
+# Python 2 only delivers KeyboardInterrupt to a thread blocked on a result
+# when it waits with a timeout.
+_WAIT_FOREVER = 60 * 60 * 24 * 365
+
+
+class ProbePool(object):
+    # Bounded fan-out for network probes. The run wide limit caps how many
+    # probes are in flight in total, the cluster limit caps how many of
+    # those belong to a single cluster. Slots are only held around the
+    # network calls themselves so nested map() calls cannot deadlock.
+
+    def __init__(
+        self,
+        concurrency=DEFAULT_CONCURRENCY,
+        cluster_concurrency=DEFAULT_CLUSTER_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self.cluster_concurrency = max(
+            1, min(cluster_concurrency or self.concurrency, self.concurrency))
+        self._run_slots = threading.BoundedSemaphore(self.concurrency)
+        self._cluster_slots = None
+
+    def for_cluster(self):
+        pool = copy.copy(self)
+        pool._cluster_slots = threading.BoundedSemaphore(
+            self.cluster_concurrency)
+        return pool
+
+    @contextlib.contextmanager
+    def slot(self):
+        held = [s for s in (self._cluster_slots, self._run_slots) if s]
+        for semaphore in held:
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            for semaphore in reversed(held):
+                semaphore.release()
+
+    def map(self, func, items):
+        items = list(items)
+        if self._cluster_slots:
+            width = self.cluster_concurrency
+        else:
+            width = self.concurrency
+        width = min(width, len(items))
+        if width <= 1:
+            return [func(item) for item in items]
+        workers = ThreadPool(width)
+        try:
+            return workers.map_async(func, items).get(_WAIT_FOREVER)
+        finally:
+            workers.close()
+            workers.join()
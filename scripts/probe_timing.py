@@ -0,0 +1,92 @@
+import contextlib
+import os
+import threading
+import time
+
+METRIC = 'mongo_monitoring_probe_seconds'
+
+
+class PhaseTimer(object):
+    # Wall time per network phase of one host: dns, connect, command,
+    # discovery, ...
+
+    def __init__(self):
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+
+class TimedProbeError(Exception):
+    # Keeps the phases measured up to a failure next to its reason.
+
+    def __init__(self, error, timings):
+        Exception.__init__(self, '{0}: {1}'.format(
+            type(error).__name__, error))
+        self.timings = timings
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+class TimingCollector(object):
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, cluster, host, timings):
+        with self._lock:
+            for phase, seconds in timings.items():
+                self._samples[(phase, cluster, host)] = seconds
+
+    def replace_clusters(self, other, clusters):
+        # The samples of clusters become those of other, hosts other did not
+        # observe drop out
+        clusters = set(clusters)
+        with other._lock:
+            samples = [
+                (key, seconds) for key, seconds in other._samples.items()
+                if key[1] in clusters]
+        with self._lock:
+            for key in [key for key in self._samples if key[1] in clusters]:
+                del self._samples[key]
+            self._samples.update(samples)
+
+    def retain_clusters(self, clusters):
+        clusters = set(clusters)
+        with self._lock:
+            for key in [
+                    key for key in self._samples if key[1] not in clusters]:
+                del self._samples[key]
+
+    def write_textfile(self, path):
+        # Written next to the target and renamed so the node exporter
+        # textfile collector never reads a partial file.
+        with self._lock:
+            samples = sorted(self._samples.items())
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as out_file:
+            out_file.write(
+                '# HELP %s Wall time of one network phase of a probe.\n' %
+                METRIC)
+            out_file.write('# TYPE %s gauge\n' % METRIC)
+            for (phase, cluster, host), seconds in samples:
+                line = u'%s{phase="%s",cluster="%s",host="%s"} %f\n' % (
+                    METRIC,
+                    escape_label(phase),
+                    escape_label(cluster),
+                    escape_label(host),
+                    seconds)
+                out_file.write(line.encode('utf-8'))
+        os.rename(temp_path, path)
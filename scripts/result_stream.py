@@ -0,0 +1,100 @@
+import functools
+import json
+import logging
+import os
+import threading
+
+from bson.son import SON
+
+log = logging.getLogger('result_stream')
+
+
+class NDJSONSink(object):
+    # Appends one JSON document per line and flushes it straight away so a
+    # crashed or interrupted run keeps everything probed so far.
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.records = 0
+        self._lock = threading.Lock()
+        if resume:
+            drop_partial_line(path)
+        self._file = open(path, 'a' if resume else 'w')
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def drop_partial_line(path, chunk_bytes=1 << 16):
+    # An interrupted run may have left its last line cut short, appending
+    # to it would glue the next record onto the broken one. The file is cut
+    # back to just after its last newline.
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as fp:
+        fp.seek(0, os.SEEK_END)
+        end = fp.tell()
+        position = end
+        while position > 0:
+            start = max(0, position - chunk_bytes)
+            fp.seek(start)
+            newline = fp.read(position - start).rfind('\n')
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            log.warning('Dropping {0} bytes of a cut off line in {1}'.format(
+                end - position, path))
+            fp.truncate(position)
+
+
+def read_records(path):
+    # Objects come back as SON, compound index keys keep their field order
+    if not os.path.exists(path):
+        return
+    with open(path) as fp:
+        for line_number, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line, object_pairs_hook=SON)
+            except ValueError:
+                # the last line of an interrupted run may be cut short
+                log.warning('Skipping unreadable line {0} of {1}'.format(
+                    line_number, path))
+
+
+def coroutine(func):
+    # Starts a generator based consumer so that it is ready for send()
+    @functools.wraps(func)
+    def start(*args, **kwargs):
+        consumer = func(*args, **kwargs)
+        next(consumer)
+        return consumer
+    return start
+
+
+def broadcast(records, consumers):
+    # One pass over records feeding every consumer. Consumers are closed in
+    # order, so each can rely on the ones before it having finished.
+    for record in records:
+        for consumer in consumers:
+            consumer.send(record)
+    for consumer in consumers:
+        consumer.close()
@@ -0,0 +1,101 @@
+import argparse
+import json
+import logging
+import random
+import string
+
+log = logging.getLogger('sample_dataset')
+
+DRIFTS = ('missing', 'extra', 'changed')
+
+
+def server_names(servers, members_per_shard=3):
+    return [
+        'shard{0}{1}.a.b.com:27017'.format(
+            index // members_per_shard + 1,
+            string.ascii_lowercase[index % members_per_shard])
+        for index in xrange(servers)]
+
+
+def namespace_names(namespaces, databases):
+    return [
+        'db{0}.coll{1}'.format(index % databases, index)
+        for index in xrange(namespaces)]
+
+
+def reference_indexes(indexes_per_namespace):
+    indexes = {'_id_': {'_id': 1}}
+    for index in xrange(1, indexes_per_namespace):
+        field = 'f{0}'.format(index)
+        indexes[field + '_1'] = {field: 1.0}
+    return indexes
+
+
+def drifted(indexes, rng):
+    indexes = dict(indexes)
+    drift = rng.choice(DRIFTS)
+    names = sorted(name for name in indexes if name != '_id_')
+    if drift == 'missing' and names:
+        del indexes[rng.choice(names)]
+    elif drift == 'changed' and names:
+        name = rng.choice(names)
+        indexes[name] = {indexes[name].keys()[0]: -1.0}
+    else:
+        field = 'x{0}'.format(rng.randint(0, 1000))
+        indexes[field + '_1'] = {field: 1.0}
+    return indexes
+
+
+def generate(
+    servers=6,
+    namespaces=3,
+    indexes_per_namespace=5,
+    drift=0.05,
+    databases=10,
+    seed=0):
+    # REFERENCE and RESULTS shaped like sample_index_results. Each
+    # (server, namespace) pair differs from the reference with probability
+    # drift by one missing, extra or changed index.
+    rng = random.Random(seed)
+    names = namespace_names(namespaces, databases)
+    indexes = reference_indexes(indexes_per_namespace)
+    reference = dict(
+        (namespace, {'index_count': len(indexes), 'indexes': indexes})
+        for namespace in names)
+    results = {'errors': [], 'servers': {}}
+    for server in server_names(servers):
+        results['servers'][server] = [
+            {namespace: drifted(indexes, rng)
+             if rng.random() < drift else indexes}
+            for namespace in names]
+    return reference, results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level='INFO',
+        format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_file', help='JSON file the dataset is written to')
+    parser.add_argument('--servers', type=int, default=6)
+    parser.add_argument('--namespaces', type=int, default=3)
+    parser.add_argument('--indexes_per_namespace', type=int, default=5)
+    parser.add_argument(
+        '--drift',
+        help='Share of (server, namespace) pairs differing from the reference',
+        type=float,
+        default=0.05)
+    parser.add_argument('--databases', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    reference, results = generate(
+        args.servers,
+        args.namespaces,
+        args.indexes_per_namespace,
+        args.drift,
+        args.databases,
+        args.seed)
+    with open(args.output_file, 'w') as out_file:
+        json.dump({'REFERENCE': reference, 'RESULTS': results}, out_file)
+    log.info('Wrote {0} servers x {1} namespaces to {2}'.format(
+        args.servers, args.namespaces, args.output_file))
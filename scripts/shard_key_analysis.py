@@ -0,0 +1,116 @@
+import csv
+
+from index_redundancy import PROTECTED_INDEXES, key_pairs
+
+COVERED = 'covered'
+MISMATCH = 'mismatch'
+MISSING = 'missing'
+UNKNOWN = 'unknown'
+RANGE = 'range'
+
+
+def key_kind(direction):
+    # hashed, range or the index type (text, 2dsphere, ...) of a key field
+    if isinstance(direction, basestring):
+        return direction
+    return RANGE
+
+
+def mismatch_reason(shard_fields, index_fields):
+    # Why an index on the shard key fields cannot serve the shard key, e.g.
+    # 'a: hashed index, range shard key'
+    reasons = []
+    for (field, wanted), (_, found) in zip(shard_fields, index_fields):
+        if key_kind(wanted) != key_kind(found):
+            reasons.append('{0}: {1} index, {2} shard key'.format(
+                field, key_kind(found), key_kind(wanted)))
+        elif wanted != found:
+            reasons.append('{0}: direction {1}, shard key {2}'.format(
+                field, found, wanted))
+    return '; '.join(reasons)
+
+
+def analyze(indexes, shard_key):
+    # Shard key coverage of a sharded collection, indexes is {name: key}.
+    # The status is covered when an index starts with the shard key,
+    # mismatch when one starts with its fields but with another kind or
+    # direction (a hashed index for a range shard key or the other way
+    # round) and missing otherwise. scatter_gather lists the secondary
+    # indexes whose first field is not the first shard key field: queries
+    # only they can serve are sent to every shard. Compound keys whose
+    # field order was lost are not compared, the status is unknown when
+    # nothing else covers the shard key.
+    shard_fields = key_pairs(shard_key)
+    if shard_fields is None:
+        return {
+            'status': UNKNOWN,
+            'index': None,
+            'reason': 'field order of the shard key unknown',
+            'scatter_gather': []
+        }
+    shard_names = [field for field, _ in shard_fields]
+    covering = []
+    mismatched = []
+    scatter_gather = []
+    unordered = []
+    for name in sorted(indexes):
+        fields = key_pairs(indexes[name])
+        if fields is None:
+            unordered.append(name)
+            continue
+        prefix = fields[:len(shard_fields)]
+        if prefix == shard_fields:
+            covering.append(name)
+        elif [field for field, _ in prefix] == shard_names:
+            mismatched.append((name, mismatch_reason(shard_fields, prefix)))
+        if (fields and name not in PROTECTED_INDEXES and
+                fields[0][0] != shard_names[0]):
+            scatter_gather.append(name)
+    if covering:
+        # the narrowest one, an exact shard key index when there is one
+        index = min(covering, key=lambda name: len(key_pairs(indexes[name])))
+        status, reason = COVERED, None
+    elif mismatched:
+        status = MISMATCH
+        index, reason = mismatched[0]
+    elif unordered:
+        status, index = UNKNOWN, None
+        reason = 'field order of {0} unknown'.format(', '.join(unordered))
+    else:
+        status, index, reason = MISSING, None, None
+    return {
+        'status': status,
+        'index': index,
+        'reason': reason,
+        'scatter_gather': scatter_gather
+    }
+
+
+def shard_key_rows(final_results):
+    # One row per sharded collection of a get_mongo_collection_indexes
+    # catalog, whose collections carry the analysis under
+    # 'shard_key_coverage'
+    for cluster, databases in sorted(final_results.items()):
+        for database, output in sorted(databases.items()):
+            for collection in output['collections']:
+                coverage = collection.get('shard_key_coverage')
+                if coverage is None:
+                    continue
+                yield (
+                    cluster,
+                    '{0}.{1}'.format(database, collection['name']),
+                    collection['shard_key'],
+                    coverage['status'],
+                    coverage['index'],
+                    coverage['reason'],
+                    ' '.join(coverage['scatter_gather']))
+
+
+def write_shard_keys(output_file, rows):
+    with open(output_file, 'w') as fp:
+        csvwriter = csv.writer(fp, delimiter=',', quotechar='"')
+        csvwriter.writerow([
+            'Cluster', 'Namespace', 'Shard key', 'Status', 'Index name',
+            'Reason', 'Scatter gather indexes'])
+        for row in rows:
+            csvwriter.writerow(row)
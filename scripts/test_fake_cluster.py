@@ -0,0 +1,374 @@
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+
+from bson.son import SON
+
+import check_mongo_config
+import check_mongo_indexes
+from cluster_scheduler import ClusterScheduler
+import get_mongo_collection_indexes
+from fake_cluster import FakeTopology, MONITORING_HOST
+from index_redundancy import analyze
+from mongo_connections import ConnectionRegistry, registry
+from result_stream import NDJSONSink, read_records
+
+# Runs against fake_cluster, no server needed:
+#     python -m unittest discover -s scripts
+SLOW_RUN_SECONDS = 60
+
+
+def setUpModule():
+    # the scripts log every host, dead ones with a traceback
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+
+class FakeClusterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = registry.factory
+        self.output_dir = tempfile.mkdtemp(prefix='test_fake_cluster')
+
+    def tearDown(self):
+        registry.close_all()
+        registry.factory = self.factory
+        shutil.rmtree(self.output_dir)
+
+    def install(self, topology):
+        registry.close_all()
+        registry.factory = topology.client
+        return topology
+
+    def output(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def load(self, name):
+        with open(self.output(name)) as fp:
+            return json.load(fp)
+
+    def run_bounded(self, func):
+        # A deadlocked run fails the test instead of hanging the suite
+        thread = threading.Thread(target=func)
+        thread.daemon = True
+        thread.start()
+        thread.join(SLOW_RUN_SECONDS)
+        self.assertFalse(thread.is_alive(), 'run did not finish')
+
+
+class CollectionIndexesTest(FakeClusterTestCase):
+
+    def collection(self, results, name):
+        for collection in results['fake']['db0']['collections']:
+            if collection['name'] == name:
+                return collection
+        self.fail('{0} not found'.format(name))
+
+    def test_index_usage_with_one_slot_per_cluster(self):
+        self.install(FakeTopology(shards=2))
+        self.run_bounded(lambda: get_mongo_collection_indexes.main(
+            MONITORING_HOST,
+            self.output('catalog'),
+            database_concurrency=1,
+            index_usage=True))
+        usage = self.collection(self.load('catalog.json'), 'coll0')['usage']
+        self.assertEqual(6, usage['_id_']['members'])
+
+    def test_compound_shard_key_keeps_its_order(self):
+        # coll2 is sharded on {f2: 1, f1: 1}
+        self.install(FakeTopology(shards=2))
+        get_mongo_collection_indexes.main(
+            MONITORING_HOST, self.output('catalog'))
+        collection = self.collection(self.load('catalog.json'), 'coll2')
+        coverage = collection['shard_key_coverage']
+        self.assertEqual('covered', coverage['status'])
+        self.assertEqual('f2_1_f1_1', coverage['index'])
+        self.assertNotIn('f2_1_f1_1', coverage['scatter_gather'])
+        self.assertEqual([{
+            'index': 'f2_1',
+            'kind': 'shard_key',
+            'covered_by': 'f2_1_f1_1'
+        }], collection['redundant'])
+
+    def test_list_catalog_matches_list_indexes(self):
+        indexes = []
+        for wire_version in (6, 17):
+            topology = self.install(
+                FakeTopology(shards=1, wire_version=wire_version))
+            topology.timeseries.add('db1.coll3')
+            get_mongo_collection_indexes.main(
+                MONITORING_HOST, self.output('catalog'))
+            indexes.append(sorted(
+                (db_name, collection['name'], collection['index_names'])
+                for db_name, output in self.load('catalog.json')[
+                    'fake'].items()
+                for collection in output['collections']))
+        self.assertEqual(indexes[0], indexes[1])
+        self.assertIn(
+            (u'db1', u'coll3', [u'_id_', u'f1_1', u'f2_1', u'f3_1']),
+            indexes[1])
+        # a single $listCatalog for every database of the cluster
+        self.assertEqual(1, topology.round_trips['aggregate'])
+
+    def test_seed_list_answers_once_connected(self):
+        topology = self.install(FakeTopology(shards=1, timeout=0.01))
+        dead = ['127.250.0.1:27017', '127.250.0.2:27017']
+        topology.monitoring_hosts[0]['hosts'] = [
+            ','.join(dead), topology.mongos[0]]
+        get_mongo_collection_indexes.main(
+            MONITORING_HOST, self.output('catalog'))
+        self.assertIn('fake', self.load('catalog.json'))
+
+    def test_warm_mongos_client_is_reused(self):
+        # the next daemon cycle finds the mongos client connected
+        self.install(FakeTopology(shards=1))
+        for _ in range(2):
+            get_mongo_collection_indexes.main(
+                MONITORING_HOST, self.output('catalog'))
+            self.assertIn('fake', self.load('catalog.json'))
+
+
+class ConfigTest(FakeClusterTestCase):
+
+    def run_config(self, topology):
+        self.install(topology)
+        check_mongo_config.main(
+            MONITORING_HOST, '3.0.0', self.output('config'), topology_ttl=0)
+        return self.load('config.json')['results']
+
+    def test_unreachable_shard_is_reported(self):
+        topology = FakeTopology(shards=2, timeout=0.01)
+        for host in topology.shards[1][1]:
+            topology.kill(host)
+        errors = self.run_config(topology)['fake']['errors']
+        self.assertEqual(1, len(errors))
+        self.assertIn(errors[0]['server'], topology.shards[1][1])
+        self.assertIn('shard1', errors[0]['error'])
+
+    def test_warm_mongos_client_is_reused(self):
+        topology = FakeTopology(shards=2)
+        first = self.run_config(topology)
+        # the next daemon cycle, the registry keeps its clients
+        check_mongo_config.main(
+            MONITORING_HOST, '3.0.0', self.output('config'), topology_ttl=0)
+        second = self.load('config.json')['results']
+        self.assertEqual([], second['fake']['errors'])
+        self.assertEqual(
+            len(first['fake']['mongod']), len(second['fake']['mongod']))
+
+    def test_shared_cluster_is_listed_under_every_label(self):
+        topology = FakeTopology(shards=2)
+        topology.monitoring_hosts.append(
+            dict(topology.monitoring_hosts[0], _id='alias'))
+        results = self.run_config(topology)
+        for label in ('fake', 'alias'):
+            self.assertEqual(6, len(results[label]['mongod']))
+            self.assertEqual(3, len(results[label]['config']))
+            self.assertEqual(2, len(results[label]['mongos']))
+
+
+class IndexesTest(FakeClusterTestCase):
+
+    def run_indexes(self, topology, name, **kwargs):
+        self.install(topology)
+        check_mongo_indexes.main(
+            ','.join(topology.mongos),
+            self.output(name),
+            False,
+            True,
+            **kwargs)
+        with open(self.output(name + '.html')) as fp:
+            return fp.read()
+
+    def test_replay_keeps_compound_key_agreement(self):
+        topology = FakeTopology(shards=2)
+        live = self.run_indexes(topology, 'live', reference_mode='majority')
+        replayed = self.run_indexes(
+            topology,
+            'replayed',
+            reference_mode='majority',
+            replay=self.output('live.ndjson'))
+        agreement = re.compile(r'db0\.coll2 - [^<]*')
+        self.assertIn('100% of 6 members agree', agreement.search(live).group())
+        self.assertEqual(
+            agreement.search(live).group(),
+            agreement.search(replayed).group())
+
+    def test_since_snapshot_keeps_compound_keys_unchanged(self):
+        topology = FakeTopology(shards=2)
+        self.run_indexes(
+            topology, 'before', snapshot_file=self.output('snapshot'))
+        host = topology.shards[0][1][1]
+        specs = dict(topology.catalog['db0']['coll2'])
+        specs['zz_1'] = {'zz': 1}
+        topology.nodes[host].drift['db0.coll2'] = specs
+        report = self.run_indexes(
+            topology, 'after', since=self.output('snapshot'))
+        self.assertIn('ADDED', report)
+        self.assertNotIn('CHANGED', report)
+
+    def test_resume_after_cut_off_line(self):
+        topology = FakeTopology(shards=2)
+        live = self.run_indexes(topology, 'live')
+        stream_file = self.output('live.ndjson')
+        with open(stream_file) as fp:
+            lines = fp.readlines()
+        # an interrupted run, half way through writing a line
+        with open(stream_file, 'w') as fp:
+            fp.writelines(lines[:len(lines) // 2])
+            fp.write(lines[len(lines) // 2][:10])
+        resumed = self.run_indexes(
+            topology, 'resumed', stream_file=stream_file, resume=True)
+        # keys read back from the stream are unicode
+        self.assertEqual(live, resumed.replace("(u'", "('").replace(
+            ", (u'", ", ('"))
+
+    def test_daemon_writes_one_textfile(self):
+        topology = self.install(FakeTopology(shards=1))
+        topology.monitoring_hosts.append(
+            dict(topology.monitoring_hosts[0],
+                 _id='alias',
+                 hosts=topology.mongos[0]))
+
+        class OneCycle(Exception):
+            pass
+
+        def stop(seconds):
+            raise OneCycle()
+
+        scheduler = check_mongo_indexes.ClusterScheduler
+        check_mongo_indexes.ClusterScheduler = lambda field: ClusterScheduler(
+            field, jitter=0, sleep=stop)
+        try:
+            self.assertRaises(
+                OneCycle,
+                check_mongo_indexes.run_daemon,
+                MONITORING_HOST,
+                self.output('daemon'),
+                False,
+                prometheus_file=self.output('indexes.prom'))
+        finally:
+            check_mongo_indexes.ClusterScheduler = scheduler
+        self.assertEqual(
+            ['indexes.prom'],
+            [name for name in os.listdir(self.output_dir) if 'prom' in name])
+        with open(self.output('indexes.prom')) as fp:
+            textfile = fp.read()
+        for hosts in (','.join(topology.mongos), topology.mongos[0]):
+            self.assertIn('cluster="{0}"'.format(hosts), textfile)
+
+    def test_system_indexes_and_list_indexes_agree(self):
+        reports = [
+            self.run_indexes(
+                FakeTopology(shards=1, wire_version=wire_version),
+                'wire{0}'.format(wire_version))
+            for wire_version in (2, 6)]
+        self.assertEqual(reports[0], reports[1])
+
+
+class StreamTest(FakeClusterTestCase):
+
+    def test_resume_drops_cut_off_line(self):
+        path = self.output('stream.ndjson')
+        with NDJSONSink(path) as sink:
+            sink.write({'n': 1})
+        with open(path, 'a') as fp:
+            fp.write('{"n":')
+        with NDJSONSink(path, resume=True) as sink:
+            sink.write({'n': 2})
+        self.assertEqual(
+            [1, 2], [record['n'] for record in read_records(path)])
+
+
+class RecordingClient(object):
+
+    def __init__(self, uri, **options):
+        self.uri = uri
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_leased_client_is_not_evicted(self):
+        clients = ConnectionRegistry(1, RecordingClient)
+        with clients.lease('127.0.0.1') as held:
+            with clients.lease('127.0.0.2') as other:
+                pass
+            self.assertFalse(held.closed)
+            self.assertTrue(other.closed)
+            with clients.lease('127.0.0.1') as again:
+                self.assertIs(held, again)
+        self.assertFalse(held.closed)
+        self.assertEqual(1, clients.stats()['open'])
+
+    def test_idle_client_is_evicted_once_released(self):
+        clients = ConnectionRegistry(1, RecordingClient)
+        with clients.lease('127.0.0.1') as first:
+            with clients.lease('127.0.0.2') as second:
+                self.assertEqual(2, clients.stats()['leased'])
+            self.assertTrue(second.closed)
+        with clients.lease('127.0.0.3'):
+            pass
+        self.assertTrue(first.closed)
+        self.assertEqual(
+            {'hits': 0, 'misses': 3, 'evictions': 2, 'open': 1, 'leased': 0},
+            clients.stats())
+
+
+class RedundancyTest(unittest.TestCase):
+
+    def assertNotCovered(self, special):
+        self.assertEqual([], analyze({'a_1': {'a': 1}, 'special': special}))
+
+    def test_text_index_covers_nothing(self):
+        self.assertNotCovered(
+            SON([('a', 1), ('_fts', 'text'), ('_ftsx', 1)]))
+
+    def test_geo_indexes_cover_nothing(self):
+        self.assertNotCovered(SON([('a', 1), ('loc', '2dsphere')]))
+        self.assertNotCovered(SON([('a', 1), ('loc', '2d')]))
+        self.assertNotCovered(
+            SON([('loc', 'geoHaystack'), ('a', 1)]))
+
+    def test_wildcard_index_covers_nothing(self):
+        self.assertNotCovered(SON([('a', 1), ('b.$**', 1)]))
+        self.assertEqual([], analyze({'a_1': {'a': 1}, 'all': {'$**': 1}}))
+
+    def test_compound_hashed_index_covers_its_prefix(self):
+        indexes = {
+            'a_hashed': {'a': 'hashed'},
+            'a_hashed_b_1': SON([('a', 'hashed'), ('b', 1)])
+        }
+        self.assertEqual([{
+            'index': 'a_hashed',
+            'kind': 'prefix',
+            'covered_by': 'a_hashed_b_1'
+        }], analyze(indexes))
+
+    def test_unordered_compound_key_is_not_analysed(self):
+        indexes = json.loads(json.dumps({
+            'b_1_a_1': SON([('b', 1), ('a', 1)]),
+            'a_1': {'a': 1}
+        }))
+        self.assertEqual([], analyze(indexes))
+
+    def test_ordered_compound_key_covers_its_prefix(self):
+        indexes = {'a_1_b_1': SON([('a', 1), ('b', 1)]), 'a_1': {'a': 1}}
+        self.assertEqual(
+            [{'index': 'a_1', 'kind': 'prefix', 'covered_by': 'a_1_b_1'}],
+            analyze(indexes))
+
+
+if __name__ == '__main__':
+    unittest.main()
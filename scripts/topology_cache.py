@@ -0,0 +1,166 @@
+import datetime
+import hashlib
+import json
+import logging
+
+from mongo_connections import normalize_hosts
+from mongo_setup import (
+    MONITORING_DB,
+    TOPOLOGY_CACHE,
+    TOPOLOGY_CACHE_MAX_TTL_SECONDS,
+    TOPOLOGY_CACHE_TTL_SECONDS)
+from probe_pool import ProbePool
+
+log = logging.getLogger('topology_cache')
+
+
+class TopologyCache(object):
+    # Discovered topologies stored in the monitoring database. An entry is
+    # only reused while it is younger than the ttl and the fingerprint of
+    # the live cluster still matches the one it was discovered under.
+
+    def __init__(self, collection, ttl_seconds=TOPOLOGY_CACHE_TTL_SECONDS):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, fingerprint):
+        oldest = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=self.ttl_seconds)
+        cached = self.collection.find_one({
+            '_id': key,
+            'fingerprint': fingerprint,
+            'updated': {'$gt': oldest}
+        })
+        if cached:
+            self.hits += 1
+            log.info('Reusing cached topology for {0}'.format(key))
+            return cached['topology']
+        self.misses += 1
+        return None
+
+    def put(self, key, fingerprint, topology):
+        self.collection.replace_one(
+            {'_id': key},
+            {
+                '_id': key,
+                'fingerprint': fingerprint,
+                'topology': topology,
+                'updated': datetime.datetime.utcnow()
+            },
+            upsert=True)
+
+
+def open_topology_cache(conn, ttl_seconds=TOPOLOGY_CACHE_TTL_SECONDS):
+    if ttl_seconds <= 0:
+        return None
+    if ttl_seconds > TOPOLOGY_CACHE_MAX_TTL_SECONDS:
+        # older entries are gone through the TTL index anyway
+        log.warning('Topology ttl {0} capped at {1} seconds'.format(
+            ttl_seconds, TOPOLOGY_CACHE_MAX_TTL_SECONDS))
+        ttl_seconds = TOPOLOGY_CACHE_MAX_TTL_SECONDS
+    return TopologyCache(conn[MONITORING_DB][TOPOLOGY_CACHE], ttl_seconds)
+
+
+def cache_key(seed):
+    hosts, _, _ = normalize_hosts(seed)
+    return ','.join(hosts)
+
+
+def digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+
+
+def sharded_fingerprint(conn):
+    # config.shards host strings change whenever a shard replica set is
+    # reconfigured, so together with the mongos list they identify the
+    # topology without contacting any shard.
+    shards = list(conn['config']['shards'].find(
+        {}, {'_id': 1, 'host': 1}).sort('_id', 1))
+    mongos = sorted(
+        mongos['_id']
+        for mongos in conn['config']['mongos'].find({}, {'_id': 1}))
+    return digest([shards, mongos]), shards, mongos
+
+
+def replica_set_fingerprint(conn):
+    is_master = conn['admin'].command('isMaster')
+    return digest([is_master.get('setName'), is_master.get('setVersion')])
+
+
+def get_config_servers(conn):
+    cmd_line_opts = conn['admin'].command('getCmdLineOpts')
+    config_servers = cmd_line_opts['parsed']['configdb'].split('/')[-1]
+    hosts = []
+    for config_server in config_servers.split(','):
+        if ":" not in config_server:
+            config_server = config_server + ':27019'
+        hosts.append(config_server)
+    return hosts
+
+
+def discover_shard(shard, get_members, pool):
+    set_name, _, candidates = shard['host'].rpartition('/')
+    for mongod in candidates.split(','):
+        try:
+            with pool.slot():
+                members = get_members(mongod)
+            return {
+                '_id': shard['_id'],
+                'set_name': set_name,
+                'members': members
+            }
+        except Exception:
+            log.exception('Error getting replica set info for {0}'.format(
+                mongod))
+    return {
+        '_id': shard['_id'],
+        'set_name': set_name,
+        'members': None,
+        'error': mongod
+    }
+
+
+def get_sharded_topology(
+    conn,
+    seed,
+    get_members,
+    cache=None,
+    pool=None,
+    include_configs=True,
+    fingerprinted=None):
+    pool = pool or ProbePool(1)
+    key = cache_key(seed)
+    if not fingerprinted:
+        with pool.slot():
+            fingerprinted = sharded_fingerprint(conn)
+    fingerprint, shards, mongos = fingerprinted
+    if cache:
+        topology = cache.get(key, fingerprint)
+        if topology and (
+                not include_configs or topology['configs'] is not None):
+            return topology
+    topology = {'configs': None, 'mongos': mongos}
+    if include_configs:
+        with pool.slot():
+            topology['configs'] = get_config_servers(conn)
+    topology['shards'] = pool.map(
+        lambda shard: discover_shard(shard, get_members, pool),
+        shards)
+    if cache and all(s['members'] is not None for s in topology['shards']):
+        cache.put(key, fingerprint, topology)
+    return topology
+
+
+def get_replica_set_topology(conn, seed, get_members, cache=None):
+    key = cache_key(seed)
+    fingerprint = replica_set_fingerprint(conn)
+    if cache:
+        members = cache.get(key, fingerprint)
+        if members:
+            return members
+    members = get_members(seed)
+    if cache:
+        cache.put(key, fingerprint, members)
+    return members
@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+
+from bson import BSON
+from bson.son import SON
+from pymongo.errors import OperationFailure
+
+# Sections dropped from serverStatus when it has to be used. Unknown
+# sections are ignored by the server so the list covers all versions.
+SERVER_STATUS_EXCLUSIONS = (
+    'asserts',
+    'backgroundFlushing',
+    'connections',
+    'cursors',
+    'dur',
+    'extra_info',
+    'globalLock',
+    'indexCounters',
+    'locks',
+    'logicalSessionRecordCache',
+    'mem',
+    'metrics',
+    'network',
+    'opLatencies',
+    'opcounters',
+    'opcountersRepl',
+    'recordStats',
+    'repl',
+    'security',
+    'storageEngine',
+    'tcmalloc',
+    'transactions',
+    'wiredTiger',
+    'writeBacksQueued',
+)
+
+log = logging.getLogger('version_probe')
+
+
+class HelloProbe(object):
+    name = 'hello'
+
+    def probe(self, conn):
+        is_master = conn['admin'].command('isMaster')
+        build_info = conn['admin'].command('buildInfo')
+        if is_master.get('msg') == 'isdbgrid':
+            process = 'mongos'
+        else:
+            process = 'mongod'
+        return process, build_info['version'], [is_master, build_info]
+
+
+class ServerStatusProbe(object):
+    name = 'server_status'
+
+    def __init__(self, exclusions=SERVER_STATUS_EXCLUSIONS):
+        self.exclusions = exclusions
+
+    def probe(self, conn):
+        command = SON([('serverStatus', 1)])
+        for section in self.exclusions:
+            command[section] = 0
+        server_status = conn['admin'].command(command)
+        return (
+            server_status['process'],
+            server_status['version'],
+            [server_status])
+
+
+class ProbeStats(object):
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, strategy, reply_bytes, seconds, failed=False):
+        with self._lock:
+            stats = self._stats.setdefault(strategy, {
+                'calls': 0,
+                'failures': 0,
+                'reply_bytes': 0,
+                'seconds': 0.0
+            })
+            stats['calls'] += 1
+            stats['reply_bytes'] += reply_bytes
+            stats['seconds'] += seconds
+            if failed:
+                stats['failures'] += 1
+
+    def summary(self):
+        with self._lock:
+            summary = {}
+            for strategy, stats in self._stats.items():
+                summary[strategy] = dict(stats)
+                succeeded = stats['calls'] - stats['failures']
+                if succeeded:
+                    summary[strategy]['avg_reply_bytes'] = (
+                        stats['reply_bytes'] / succeeded)
+                    summary[strategy]['avg_seconds'] = (
+                        stats['seconds'] / stats['calls'])
+            return summary
+
+
+class VersionProber(object):
+    # Tries each strategy in turn, falling back to the next one when the
+    # server rejects a command (old versions, restricted roles).
+
+    def __init__(self, strategies):
+        self.strategies = strategies
+        self.stats = ProbeStats()
+
+    def probe(self, conn):
+        error = None
+        for strategy in self.strategies:
+            start = time.time()
+            try:
+                process, version, replies = strategy.probe(conn)
+            except OperationFailure as e:
+                self.stats.record(
+                    strategy.name, 0, time.time() - start, failed=True)
+                log.debug('Probe {0} failed: {1}'.format(strategy.name, e))
+                error = e
+                continue
+            reply_bytes = sum(len(BSON.encode(reply)) for reply in replies)
+            self.stats.record(strategy.name, reply_bytes, time.time() - start)
+            return process, version
+        raise error
+
+
+PROBES = {
+    'hello': lambda: [HelloProbe(), ServerStatusProbe()],
+    'server_status': lambda: [ServerStatusProbe()],
+    'full_server_status': lambda: [
+        ServerStatusProbe(exclusions=('recordStats',))],
+}
+DEFAULT_PROBE = 'hello'
+
+
+def get_prober(name=DEFAULT_PROBE):
+    return VersionProber(PROBES[name]())